@@ -0,0 +1,93 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from database.db_auth import AdminRoleRequired, InvalidLogin
+from database.db_pool import ConnectionPool, POOL_SIZE
+
+
+class AsyncScripts:
+    """
+    Coroutine versions of the script.py actions, to be awaited from asyncio services.
+    They return structured results instead of printing, and raise InvalidLogin or
+    AdminRoleRequired instead of printing the error messages. The database work runs
+    on a dedicated thread pool, with pooled connections, so the event loop never blocks
+    """
+
+    def __init__(self, db_name='dbsqlite3', workers=POOL_SIZE):
+        self.pool = ConnectionPool(db_name, workers)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='scripts-db')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Wait for the running queries, then close the pooled connections"""
+
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.pool.close()
+
+    async def run(self, query, login, password, admin_only=False):
+        """Authenticate the user and run query(handler, session) on the executor"""
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(self.run_query, query, login, password, admin_only)
+        )
+
+    def run_query(self, query, login, password, admin_only):
+        with self.pool.reader() as handler:
+            session = handler.authenticate_user(login, password)
+
+            if session is None:
+                raise InvalidLogin(login)
+            if admin_only and session.role != 'admin':
+                raise AdminRoleRequired(login)
+
+            return query(handler, session)
+
+    """ADMIN ONLY METHODS"""
+
+    async def print_all_accounts(self, login, password) -> int:
+        """Total number of valid accounts"""
+
+        return await self.run(
+            lambda handler, session: handler.count_users(), login, password, admin_only=True
+        )
+
+    async def print_oldest_account(self, login, password) -> dict:
+        """Name, e-mail address and creation time of the longest existing account"""
+
+        return await self.run(
+            lambda handler, session: handler.oldest_user(), login, password, admin_only=True
+        )
+
+    async def group_by_age(self, login, password) -> list:
+        """Children counts by age, sorted by count (ascending)"""
+
+        return await self.run(
+            lambda handler, session: handler.children_age_groups(),
+            login,
+            password,
+            admin_only=True,
+        )
+
+    """BOTH ADMIN AND USER METHODS"""
+
+    async def print_children(self, login, password) -> list:
+        """The logged-in user's children, sorted by name"""
+
+        return await self.run(
+            lambda handler, session: handler.user_children(session.user_id), login, password
+        )
+
+    async def find_similar_children_by_age(self, login, password) -> list:
+        """Users with children of the same age as at least one of the user's own children"""
+
+        return await self.run(
+            lambda handler, session: list(handler.similar_children_by_age(session.user_id)),
+            login,
+            password,
+        )
@@ -0,0 +1,181 @@
+import argparse
+import csv
+import json
+import random
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from database.db_time import format_time
+
+FORMATS = ('json', 'csv', 'xml')
+FIELDS = ('firstname', 'telephone_number', 'email', 'password', 'role', 'created_at', 'children')
+
+FIRST_NAMES = (
+    'Anna', 'Brian', 'Caroline', 'Danny', 'Erica', 'Frank', 'George', 'Hannah',
+    'Joan', 'Justin', 'Karen', 'Logan', 'Mindy', 'Patricia', 'Rachel', 'Steven',
+)
+PASSWORD_CHARACTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#%&()*+^_'
+FIRST_CREATED_AT = 1640995200  # 2022-01-01 00:00:00
+CREATED_AT_SPAN = 2 * 365 * 86400
+
+# The account used to log in when timing the actions; always valid, admin, with children
+BENCHMARK_LOGIN = 'user0@example.com'
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def generate_users(count, duplicate_rate=0.1, invalid_rate=0.05, seed=0):
+    """
+    Yield count users in the common format of the data files, the same ones for the same seed.
+    About duplicate_rate of them repeat the e-mail or phone number of an earlier user (with their
+    own creation time), about invalid_rate have a malformed e-mail or phone number
+    """
+
+    rnd = random.Random(seed)
+
+    for i in range(count):
+        user_number = i
+        if i > 1 and rnd.random() < duplicate_rate:
+            user_number = rnd.randrange(1, i)  # Repeat an earlier user's login (never the first one)
+
+        email = f'user{user_number}@example.com'
+        telephone_number = str(100000000 + user_number)
+        if i and rnd.random() < duplicate_rate / 2:
+            # Same phone number, different e-mail address: overwrites by phone number
+            email = f'user{i}.other@example.com'
+
+        if i and rnd.random() < invalid_rate:
+            if rnd.random() < 0.5:
+                email = email.replace('@', '')
+            else:
+                telephone_number = telephone_number[:5]
+        elif rnd.random() < 0.3:
+            telephone_number = rnd.choice(('+48', '00', '(48) ')) + telephone_number
+
+        yield {
+            'firstname': rnd.choice(FIRST_NAMES),
+            'telephone_number': telephone_number,
+            'email': email,
+            'password': BENCHMARK_PASSWORD if i == 0 else ''.join(rnd.choices(PASSWORD_CHARACTERS, k=10)),
+            'role': 'admin' if i == 0 else rnd.choice(('admin', 'user')),
+            'created_at': format_time(FIRST_CREATED_AT + rnd.randrange(CREATED_AT_SPAN)),
+            'children': [
+                {'name': rnd.choice(FIRST_NAMES), 'age': rnd.randint(1, 18)}
+                for _ in range(2 if i == 0 else rnd.randint(0, 3))
+            ],
+        }
+
+
+def generate(directory, count, formats=FORMATS, files_per_format=1, **options):
+    """
+    Write count generated users into data files of the given formats (users_<n>.<format>),
+    spreading them round-robin over the files. Return the paths of the written files
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    writers = [
+        WRITERS[format](directory / f'users_{number}.{format}')
+        for number in range(1, files_per_format + 1)
+        for format in formats
+    ]
+
+    for i, user in enumerate(generate_users(count, **options)):
+        writers[i % len(writers)].write(user)
+
+    for writer in writers:
+        writer.close()
+
+    return [writer.path for writer in writers]
+
+
+class JsonWriter:
+    """Writes the users as one JSON array, one user at a time"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.file.write('[')
+        self.separator = '\n'
+
+    def write(self, user):
+        self.file.write(self.separator + json.dumps(user))
+        self.separator = ',\n'
+
+    def close(self):
+        self.file.write('\n]\n')
+        self.file.close()
+
+
+class CsvWriter:
+    """Writes the users with ';' separated columns, children as 'name (age)' lists"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file, delimiter=';', lineterminator='\n')
+        self.writer.writerow(FIELDS)
+
+    def write(self, user):
+        children = ','.join(f"{child['name']} ({child['age']})" for child in user['children'])
+        self.writer.writerow([user[field] for field in FIELDS[:-1]] + [children])
+
+    def close(self):
+        self.file.close()
+
+
+class XmlWriter:
+    """Writes the users as <users><user>...</user></users>"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.file.write('<users>')
+
+    def write(self, user):
+        fields = ''.join(
+            f'<{field}>{escape(str(user[field]))}</{field}>' for field in FIELDS[:-1]
+        )
+        children = ''.join(
+            f"<child><name>{escape(child['name'])}</name><age>{child['age']}</age></child>"
+            for child in user['children']
+        )
+        self.file.write(f'<user>{fields}<children>{children}</children></user>\n')
+
+    def close(self):
+        self.file.write('</users>\n')
+        self.file.close()
+
+
+WRITERS = {'json': JsonWriter, 'csv': CsvWriter, 'xml': XmlWriter}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write synthetic data files in the format of database/data'
+    )
+    parser.add_argument('directory', help='Directory to write the data files to')
+    parser.add_argument('--users', type=int, default=1000, help='Number of users to generate')
+    parser.add_argument(
+        '--formats', nargs='+', choices=FORMATS, default=list(FORMATS), help='File formats to write'
+    )
+    parser.add_argument('--files-per-format', type=int, default=1, help='Data files of each format')
+    parser.add_argument(
+        '--duplicate-rate', type=float, default=0.1, help='Share of users repeating an earlier login'
+    )
+    parser.add_argument(
+        '--invalid-rate', type=float, default=0.05, help='Share of users with a malformed login'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generator')
+
+    args = parser.parse_args()
+
+    generate(
+        args.directory,
+        args.users,
+        args.formats,
+        args.files_per_format,
+        duplicate_rate=args.duplicate_rate,
+        invalid_rate=args.invalid_rate,
+        seed=args.seed,
+    )
@@ -0,0 +1,247 @@
+import argparse
+import io
+import json
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.generate_data import BENCHMARK_LOGIN, BENCHMARK_PASSWORD, FORMATS, generate
+from database import db_auth
+from database.db_manager import DataHandler
+from database.db_memory import MemoryStorage
+from database.db_snapshot import export_snapshot, load_snapshot
+from script import Scripts
+
+ACTIONS = (
+    'print_all_accounts',
+    'print_oldest_account',
+    'group_by_age',
+    'print_children',
+    'find_similar_children_by_age',
+)
+DEFAULT_SIZES = (1000, 10_000)
+DEFAULT_RESULTS = Path(__file__).parent / 'results.json'
+NOISE_FLOOR = 0.001  # Seconds; differences below it are never reported as regressions
+DEFAULT_HASH_ITERATIONS = db_auth.HASH_ITERATIONS
+INGEST_BUDGET = 0.004  # Seconds per user create_database may take at the default hash rounds
+
+
+def timed(function, *args, **kwargs):
+    """Seconds the call took"""
+
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def timed_action(scripts, action):
+    """Seconds the action took, making sure it did its work rather than failing the login"""
+
+    start = time.perf_counter()
+    result = getattr(scripts, action)(BENCHMARK_LOGIN, BENCHMARK_PASSWORD)
+    seconds = time.perf_counter() - start
+
+    if result.status != 'ok':
+        raise RuntimeError(f'{action} failed: {result.message}')
+    return seconds
+
+
+def benchmark_size(directory, users, repeat, workers, **generator_options):
+    """Generate users into directory, then time the ingest and every action on them"""
+
+    data_directory = directory / 'data'
+    timings = {
+        'generate': timed(generate, data_directory, users, **generator_options),
+    }
+
+    # Every timing is the best of repeat runs; the ingest and the snapshot imports start from
+    # a new database each time, the cold actions from an empty session cache
+    db_handlers = [DataHandler(str(directory / f'db_{run}')) for run in range(repeat)]
+    timings['create_database'] = min(
+        timed(handler.create_database, data_directory=data_directory, workers=workers)
+        for handler in db_handlers
+    )
+    for handler in db_handlers[1:]:
+        handler.connection.close()
+    db_handler = db_handlers[0]
+
+    timings['create_database_unchanged'] = min(
+        timed(db_handler.create_database, data_directory=data_directory, workers=workers)
+        for _ in range(repeat)
+    )
+    timings['ingested_users'] = db_handler.count_users()
+
+    # Cold start from a snapshot instead of the data files
+    snapshot = directory / 'snapshot'
+    timings['export_snapshot'] = min(
+        timed(export_snapshot, db_handler, snapshot) for _ in range(repeat)
+    )
+    restored_handlers = [
+        DataHandler(str(directory / f'restored_db_{run}')) for run in range(repeat)
+    ]
+    timings['import_snapshot'] = min(
+        timed(load_snapshot, snapshot, handler) for handler in restored_handlers
+    )
+    for handler in restored_handlers:
+        handler.connection.close()
+    timings['import_snapshot_memory'] = min(
+        timed(load_snapshot, snapshot, MemoryStorage()) for _ in range(repeat)
+    )
+
+    for action in ACTIONS:
+        # The first run verifies the password; the next ones are served by the session cache
+        scripts = Scripts(db_handler, out=io.StringIO())
+        cold = []
+        for _ in range(repeat):
+            db_handler.sessions.clear()
+            cold.append(timed_action(scripts, action))
+        timings[f'{action}_cold'] = min(cold)
+        timings[action] = min(timed_action(scripts, action) for _ in range(repeat))
+
+    db_handler.connection.close()
+
+    return timings
+
+
+def find_regressions(results, baseline, tolerance):
+    """(size, metric, baseline seconds, seconds) of the timings slower than the baseline allows"""
+
+    for setting in ('hash_iterations', 'generator'):
+        if baseline.get(setting) != results[setting]:
+            raise ValueError(f'The baseline was taken with a different {setting} setting')
+
+    regressions = []
+
+    for size, timings in results['sizes'].items():
+        for metric, seconds in timings.items():
+            before = baseline.get('sizes', {}).get(size, {}).get(metric)
+            if before is None or metric == 'ingested_users':
+                continue
+            if seconds > before * (1 + tolerance) and seconds - before > NOISE_FLOOR:
+                regressions.append((size, metric, before, seconds))
+
+    return regressions
+
+
+def find_slow_ingests(results, budget):
+    """
+    (size, seconds per user) of the ingests slower than the budget. Only checked at the default
+    hash rounds, as hashing the passwords is most of the ingest time
+    """
+
+    if results['hash_iterations'] != DEFAULT_HASH_ITERATIONS:
+        return []
+
+    return [
+        (size, timings['create_database'] / int(size))
+        for size, timings in results['sizes'].items()
+        if timings['create_database'] > budget * int(size)
+    ]
+
+
+def run(sizes, repeat=5, workers=None, hash_iterations=None, **generator_options):
+    """Benchmark every size, returning the timings along with the environment they were taken in"""
+
+    if hash_iterations:
+        db_auth.HASH_ITERATIONS = hash_iterations
+
+    results = {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'hash_iterations': db_auth.HASH_ITERATIONS,
+        'hash_threads': db_auth.HASH_THREADS,
+        'generator': generator_options,
+        'sizes': {},
+    }
+
+    for users in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            results['sizes'][str(users)] = benchmark_size(
+                Path(directory), users, repeat, workers, **generator_options
+            )
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time create_database and every action on generated data'
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of users to benchmark'
+    )
+    parser.add_argument(
+        '--formats', nargs='+', choices=FORMATS, default=list(FORMATS), help='Data file formats'
+    )
+    parser.add_argument('--files-per-format', type=int, default=1, help='Data files of each format')
+    parser.add_argument(
+        '--duplicate-rate', type=float, default=0.1, help='Share of users repeating an earlier login'
+    )
+    parser.add_argument(
+        '--invalid-rate', type=float, default=0.05, help='Share of users with a malformed login'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generator')
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='Runs of every timing, the best is kept'
+    )
+    parser.add_argument('--workers', type=int, help='Processes parsing the data files')
+    parser.add_argument(
+        '--hash-iterations',
+        type=int,
+        help='PBKDF2 rounds per password; lower it to time the rest of the ingest at large sizes',
+    )
+    parser.add_argument(
+        '--output', default=DEFAULT_RESULTS, help='File to record the results in (JSON)'
+    )
+    parser.add_argument(
+        '--ingest-budget',
+        type=float,
+        default=INGEST_BUDGET,
+        help='Seconds per user create_database may take at the default hash rounds',
+    )
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help='How much slower than the baseline a timing may be, as a fraction',
+    )
+
+    args = parser.parse_args()
+
+    results = run(
+        args.sizes,
+        args.repeat,
+        args.workers,
+        args.hash_iterations,
+        formats=args.formats,
+        files_per_format=args.files_per_format,
+        duplicate_rate=args.duplicate_rate,
+        invalid_rate=args.invalid_rate,
+        seed=args.seed,
+    )
+    Path(args.output).write_text(json.dumps(results, indent=2) + '\n')
+
+    for size, timings in results['sizes'].items():
+        print(f'\n{size} users')
+        for metric, seconds in timings.items():
+            print(f'  {metric}: {seconds if metric == "ingested_users" else f"{seconds:.4f}s"}')
+
+    slow_ingests = find_slow_ingests(results, args.ingest_budget)
+    for size, seconds in slow_ingests:
+        print(f'\nSLOW INGEST {size} users: {seconds * 1000:.2f}ms per user')
+
+    regressions = []
+    if args.baseline:
+        regressions = find_regressions(
+            results, json.loads(Path(args.baseline).read_text()), args.tolerance
+        )
+        for size, metric, before, seconds in regressions:
+            print(f'\nREGRESSION {size} users, {metric}: {before:.4f}s -> {seconds:.4f}s')
+
+    if slow_ingests or regressions:
+        sys.exit(1)
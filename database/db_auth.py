@@ -0,0 +1,154 @@
+import hashlib
+import hmac
+import html
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+HASH_PREFIX = f'{HASH_ALGORITHM}$'  # Start of every stored hash
+HASH_ITERATIONS = 10_000  # Stored with every hash, so it can be raised without breaking old ones
+HASH_THREADS = os.cpu_count() or 1  # Threads hashing the passwords of a written batch
+SESSIONS_LIMIT = 10_000  # Verified logins kept by a SessionCache
+SESSION_TTL = 300  # Seconds a verified login is trusted without asking the database
+SESSION_KEY = os.urandom(32)  # Secret of the password digests in the session caches, per process
+
+Session = namedtuple('Session', ['user_id', 'email', 'telephone_number', 'role'])
+
+
+class InvalidLogin(Exception):
+    """The login and password do not match any user"""
+
+
+class AdminRoleRequired(Exception):
+    """An admin only action was requested by a user without the admin role"""
+
+
+def hash_password(password, iterations=None):
+    """Salted hash of the password, as stored in users.password (HASH_ITERATIONS rounds by default)"""
+
+    iterations = iterations or HASH_ITERATIONS
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac(
+        'sha256', html.unescape(password).encode(), salt, iterations
+    )
+
+    return f'{HASH_ALGORITHM}${iterations}${salt.hex()}${digest.hex()}'
+
+
+def hash_passwords(passwords, threads=None):
+    """
+    hash_password of every password, in order. The hashes are computed by HASH_THREADS
+    threads at once, as pbkdf2_hmac releases the GIL while it runs
+    """
+
+    threads = threads or HASH_THREADS
+    if threads == 1 or len(passwords) < 2:
+        return [hash_password(password) for password in passwords]
+
+    from concurrent.futures import ThreadPoolExecutor  # Ingest only
+
+    with ThreadPoolExecutor(min(threads, len(passwords))) as executor:
+        return list(executor.map(hash_password, passwords))
+
+
+def verify_password(password, password_hash):
+    """
+    Check the password against a hash made by hash_password, or against a plaintext password
+    left by an older version until create_database hashes it
+    """
+
+    if isinstance(password_hash, str) and not is_password_hash(password_hash):
+        # Use html module to escape '&amp' chars, as the plaintext passwords were compared
+        return hmac.compare_digest(
+            html.unescape(password).encode(), html.unescape(password_hash).encode()
+        )
+
+    try:
+        algorithm, iterations, salt, digest = password_hash.split('$')
+    except (AttributeError, ValueError):
+        return False
+    if algorithm != HASH_ALGORITHM:
+        return False
+
+    # Use html module to escape '&amp' chars, as the passwords were compared before hashing
+    candidate = hashlib.pbkdf2_hmac(
+        'sha256', html.unescape(password).encode(), bytes.fromhex(salt), int(iterations)
+    )
+
+    return hmac.compare_digest(candidate.hex(), digest)
+
+
+def is_password_hash(password):
+    """Check if the stored password is already hashed"""
+
+    return password.startswith(HASH_PREFIX)
+
+
+class SessionCache:
+    """
+    Bounded LRU cache of verified logins, each trusted for ttl seconds.
+    Entries of a user are dropped as soon as the user's row is rewritten
+    """
+
+    def __init__(self, limit=SESSIONS_LIMIT, ttl=SESSION_TTL):
+        self.limit = limit
+        self.ttl = ttl
+        self.sessions = OrderedDict()  # (login, password digest) -> (session, expiry time)
+        self.user_keys = {}  # user_id -> keys of its sessions
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(login, password):
+        # Only a digest of the password is kept in memory, keyed by a random secret so it cannot
+        # be cracked faster than the stored PBKDF2 hashes
+        return login, hmac.new(SESSION_KEY, password.encode(), 'sha256').digest()
+
+    def get(self, login, password):
+        key = self.key(login, password)
+
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self.remove(key)
+                return None
+
+            self.sessions.move_to_end(key)
+            return entry[0]
+
+    def add(self, login, password, session):
+        key = self.key(login, password)
+
+        with self.lock:
+            self.sessions[key] = (session, time.monotonic() + self.ttl)
+            self.sessions.move_to_end(key)
+            self.user_keys.setdefault(session.user_id, set()).add(key)
+
+            while len(self.sessions) > self.limit:  # Drop the least recently used
+                self.remove(next(iter(self.sessions)))
+
+    def invalidate(self, user_ids):
+        """Forget the sessions of users whose rows have changed"""
+
+        with self.lock:
+            for user_id in user_ids:
+                for key in self.user_keys.pop(user_id, ()):
+                    self.sessions.pop(key, None)
+
+    def clear(self):
+        """Forget every session, e.g. once the whole database has been replaced"""
+
+        with self.lock:
+            self.sessions.clear()
+            self.user_keys.clear()
+
+    def remove(self, key):
+        session, _ = self.sessions.pop(key)
+        keys = self.user_keys.get(session.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[session.user_id]
@@ -1,18 +1,203 @@
+import os
 import sqlite3
 import json
-import re
-from datetime import datetime
+import hashlib
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby, islice
+from pathlib import Path
 
-from .db_parser import DataParser
+from . import db_metrics
+from .db_auth import HASH_PREFIX, hash_passwords
+from .db_records import Child, children_as_dicts
+from .db_storage import BATCH_SIZE, Storage
+from .db_time import format_time, parse_time
 
+SQL_VARIABLES_LIMIT = 500  # Values bound per 'IN (...)' lookup
+HASH_CHUNK_SIZE = 1 << 20  # Bytes read at once when hashing a data file
 
-class DataHandler:
-    def __init__(self, db_name):
+
+class DataHandler(Storage):
+    """The storage engine keeping the users in a SQLite database file"""
+
+    # Schema upgrade steps, run in order; PRAGMA user_version holds how many were applied
+    SCHEMA_MIGRATIONS = (
+        'add_lookup_indexes',
+        'add_ingested_files_table',
+        'add_children_table',
+        'defer_password_hashing',
+        'add_user_stats',
+        'store_created_at_as_epoch',
+    )
+
+    def __init__(self, db_name, connection=None, sessions=None):
+        super().__init__(sessions)
         self.db_name = db_name
-        self.connection = sqlite3.connect(self.db_name)
+        # An already opened connection and session cache may be passed, e.g. by the ConnectionPool
+        self.connection = connection or sqlite3.connect(self.db_name)
         self.cursor = self.connection.cursor()
 
-    def create_database(self):
+        self.upgrade_schema()  # Migrate databases built by older versions in place
+
+    def create_database(
+        self,
+        batch_size=BATCH_SIZE,
+        data_directory=None,
+        manifest=None,
+        workers=None,
+        incremental=True,
+        shadow=False,
+    ):
+        """
+        Create the users table and populate it with every data file found in
+        data_directory (the bundled data by default) or listed in the manifest,
+        parsed by the given number of worker processes. In incremental mode the
+        files ingested before are skipped, unless they have changed since.
+        With shadow, the files are ingested into a copy of the database, swapped in at the end
+        """
+
+        from .db_parser import DataParser  # Ingest only, kept out of the query actions' startup
+
+        self.create_tables()
+
+        if shadow:
+            self.create_shadow_database(
+                batch_size=batch_size,
+                data_directory=data_directory,
+                manifest=manifest,
+                workers=workers,
+                incremental=incremental,
+            )
+            return
+
+        with db_metrics.timer('hash_passwords'):
+            self.hash_plaintext_passwords()
+
+        # Parse the data and populate the database. Files are applied in a fixed order,
+        # so the newest record wins the same way whether they are parsed in parallel or not
+        with db_metrics.timer('find_sources'):
+            sources = DataParser.discover_sources(data_directory, manifest)
+            pending_sources = self.find_pending_sources(sources, incremental)
+        db_metrics.count('files_skipped', len(sources) - len(pending_sources))
+
+        parsed_sources = DataParser.iter_sources(
+            [(path, format, offset) for path, format, offset, _ in pending_sources], workers
+        )
+        for (path, _, _, file_state), (format, user_data) in zip(
+            pending_sources, parsed_sources
+        ):
+            self.add_data(user_data, format=format, batch_size=batch_size)
+            db_metrics.count(f'files_ingested_{format}')
+
+            with self.connection:  # Recorded only once all the rows of the file are written
+                self.record_ingested_file(path, file_state)
+
+    def create_shadow_database(self, **options):
+        """
+        Run create_database on a shadow copy of the database file, then copy the result back
+        over the database in a single transaction. The database is switched to WAL mode first,
+        so the readers keep being served from the previous users until the copy commits, and
+        never see part of an ingest; the copy back is the only time the writer holds a lock.
+        This handler is assumed to be the only writer: the database is not locked during the
+        ingest, so if anything else commits to it meanwhile, the ingest is dropped (RuntimeError)
+        rather than copied back over that commit
+        """
+
+        self.connection.commit()
+        self.connection.execute('PRAGMA journal_mode=WAL').fetchone()
+        data_version = self.data_version()
+
+        shadow_name = f'{self.db_name}.shadow'
+        self.remove_database_files(shadow_name)  # Left behind by an interrupted run
+
+        try:
+            shadow_connection = sqlite3.connect(shadow_name)
+            try:
+                with db_metrics.timer('shadow_copy'):
+                    self.connection.backup(shadow_connection)
+
+                DataHandler(shadow_name, shadow_connection).create_database(**options)
+            finally:
+                shadow_connection.close()
+
+            with db_metrics.timer('shadow_swap'):
+                self.copy_shadow_database(shadow_name, data_version)
+        finally:
+            self.remove_database_files(shadow_name)
+
+        self.sessions.clear()  # Any user may have changed at once
+
+    def copy_shadow_database(self, shadow_name, data_version):
+        """
+        Replace the rows of every table with those of the shadow database, in one transaction.
+        The write lock is taken before making sure no other connection has committed since
+        data_version was read, so no commit can land between the check and the copy
+        """
+
+        self.cursor.execute('ATTACH DATABASE ? AS shadow', (shadow_name,))
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            try:
+                if self.data_version() != data_version:
+                    raise RuntimeError(
+                        f'{self.db_name} was changed during the shadow ingest, which is dropped'
+                    )
+
+                self.cursor.execute(
+                    """
+                    SELECT name
+                    FROM shadow.sqlite_master
+                    WHERE type='table'
+                    """
+                )
+                tables = [name for (name,) in self.cursor.fetchall()]
+                # Every table is emptied before any is filled, so no row is deleted by a cascade
+                for table in tables:
+                    self.cursor.execute(f'DELETE FROM main.{table}')
+                for table in tables:
+                    self.cursor.execute(f'INSERT INTO main.{table} SELECT * FROM shadow.{table}')
+            except BaseException:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+        finally:
+            self.cursor.execute('DETACH DATABASE shadow')
+
+    def data_version(self):
+        """Number changing whenever another connection commits to the database"""
+
+        return self.connection.execute('PRAGMA main.data_version').fetchone()[0]
+
+    @staticmethod
+    def remove_database_files(db_name):
+        """Delete a database file along with its journal files"""
+
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            try:
+                os.remove(db_name + suffix)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Run the enclosed queries in one read transaction, all of them on the same snapshot of
+        the database, however many commits happen meanwhile (in WAL mode, without blocking them)
+        """
+
+        if self.connection.in_transaction:  # Already reading (or writing) in a transaction
+            yield self
+            return
+
+        self.connection.execute('BEGIN')
+        try:
+            yield self
+        finally:
+            self.connection.rollback()
+
+    def create_tables(self):
+        """Create the users table, then bring the rest of the schema up to date"""
+
         self.cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -27,169 +212,779 @@ class DataHandler:
             )
             """
         )
+        self.upgrade_schema()
+
+    def find_pending_sources(self, sources, incremental=True):
+        """
+        Return (path, format, offset, file_state) for the sources that need to be ingested.
+        Files not changed since the last run are skipped, as are files whose content was
+        ingested before under any path (e.g. by the database a snapshot was taken of), and
+        .csv files that were only appended to are read from the first line not ingested yet
+        """
 
-        # Parse the data and populate the database
-        json_data = DataParser.parse_json('users.json')
-        csv_data1, csv_data2 = DataParser.parse_csv('users_')
-        xml_data1, xml_data2 = DataParser.parse_xml('users_')
+        pending_sources = []
 
-        self.add_data(json_data, format='json')
+        for path, format in sources:
+            stat = path.stat()
+            ingested = self.find_ingested_file(path) if incremental else None
 
-        self.add_data(csv_data1, format='csv')
-        self.add_data(csv_data2, format='csv')
+            if ingested and ingested[:2] == (stat.st_size, stat.st_mtime_ns):
+                continue  # Unchanged since the last run
 
-        self.add_data(xml_data1, format='xml')
-        self.add_data(xml_data2, format='xml')
+            file_state = self.read_file_state(path, ingested[0] if ingested else None)
+            file_state['mtime_ns'] = stat.st_mtime_ns
 
-    def add_data(self, user_data, format):
-        """Verify the provided data and then, add it to the database"""
+            if incremental and self.is_ingested_content(file_state['sha256']):
+                # Only touched, or moved: remember it under this path and mtime, so the file
+                # is not hashed again
+                with self.connection:
+                    self.record_ingested_file(path, file_state)
+                continue
 
-        common_data = DataParser.convert_to_common_format(user_data, format)
+            offset = 0
+            if ingested and format == 'csv' and file_state['prefix_sha256'] == ingested[2]:
+                offset = ingested[3]  # Append-only change: read the new rows only
 
-        for user in common_data:
-            current_system_time = datetime.now()
-            current_user_time = datetime.strptime(
-                user['created_at'], '%Y-%m-%d %H:%M:%S'
+            pending_sources.append((path, format, offset, file_state))
+
+        return pending_sources
+
+    def find_ingested_file(self, path):
+        """
+        (size, mtime_ns, sha256, resume_offset) recorded for the file, or None. Files restored
+        from a snapshot are recorded by their name, with no mtime
+        """
+
+        for key in (str(path.resolve()), path.name):
+            self.cursor.execute(
+                """
+                SELECT size, mtime_ns, sha256, resume_offset
+                FROM ingested_files
+                WHERE path=?
+                """,
+                (key,),
             )
+            ingested = self.cursor.fetchone()
+            if ingested:
+                return ingested
 
-            # Phone number with trailing zeros, non-digit characters, etc. replaced.
-            fixed_phone_num = re.sub(r'\D', '', user['telephone_number'])[-9:]
+        return None
 
-            if (
-                # Verify that all criteria have been successfully met
-                self.validate_email(user['email']) is True
-                and self.validate_phone_num(user['telephone_number']) is True
-            ):
-                data_repeated = self.check_if_data_is_repeated(user, fixed_phone_num)
-                if not data_repeated:  # Populate the database if no repetitions were found
-                    self.cursor.execute(
-                        """
-                    INSERT INTO users (firstname, telephone_number, email, password, role, created_at, children)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+    def is_ingested_content(self, sha256):
+        """Check if a file with this content was ingested, whatever its path"""
+
+        self.cursor.execute(
+            """
+            SELECT 1
+            FROM ingested_files
+            WHERE sha256=?
+            LIMIT 1
+            """,
+            (sha256,),
+        )
+
+        return self.cursor.fetchone() is not None
+
+    @staticmethod
+    def read_file_state(path, prefix_size=None):
+        """
+        Hash the file in a single pass. Along with the hash of the whole file, return
+        the hash of its first prefix_size bytes (to tell whether the file was only
+        appended to) and the offset where its last complete line ends
+        """
+
+        file_hash = hashlib.sha256()
+        prefix_hash = None
+        position = 0
+        resume_offset = 0
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                if prefix_size is not None and position <= prefix_size < position + len(chunk):
+                    file_hash.update(chunk[: prefix_size - position])
+                    prefix_hash = file_hash.hexdigest()
+                    file_hash.update(chunk[prefix_size - position :])
+                else:
+                    file_hash.update(chunk)
+
+                last_newline = chunk.rfind(b'\n')
+                if last_newline != -1:
+                    resume_offset = position + last_newline + 1
+                position += len(chunk)
+
+        if prefix_size == position:
+            prefix_hash = file_hash.hexdigest()
+
+        return {
+            'size': position,
+            'sha256': file_hash.hexdigest(),
+            'prefix_sha256': prefix_hash,
+            'resume_offset': resume_offset,
+        }
+
+    def record_ingested_file(self, path, file_state):
+        """Remember the state of an ingested file, to skip it on the next run if it does not change"""
+
+        self.cursor.execute(
+            """
+            INSERT OR REPLACE INTO ingested_files (path, size, mtime_ns, sha256, resume_offset)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (
+                str(path.resolve()),
+                file_state['size'],
+                file_state['mtime_ns'],
+                file_state['sha256'],
+                file_state['resume_offset'],
+            ),
+        )
+
+    def iter_ingested_files(self):
+        self.cursor.execute(
+            """
+            SELECT path, sha256, size, resume_offset
+            FROM ingested_files
+            ORDER BY path
+            """
+        )
+
+        for path, sha256, size, resume_offset in self.cursor.fetchall():
+            yield Path(path).name, sha256, size, resume_offset
+
+    def restore_ingested_files(self, files):
+        """
+        Record the files by their name, as their paths differ from one machine to another.
+        Of files having the same name, the first one is kept
+        """
+
+        with self.connection:
+            self.cursor.executemany(
+                """
+                INSERT OR IGNORE INTO ingested_files (path, size, mtime_ns, sha256, resume_offset)
+                VALUES (?, ?, NULL, ?, ?)
+                """,
+                [(name, size, sha256, resume_offset) for name, sha256, size, resume_offset in files],
+            )
+
+    def upgrade_schema(self):
+        """Apply the schema migrations the database has not gone through yet"""
+
+        self.cursor.execute(
+            """
+            SELECT name
+            FROM sqlite_master
+            WHERE type='table' AND name='users'
+            """
+        )
+        if self.cursor.fetchone() is None:  # Nothing to migrate before create_database
+            return
+
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+
+        for migration in self.SCHEMA_MIGRATIONS[version:]:
+            version += 1
+            with self.connection:
+                getattr(self, migration)()
+                self.cursor.execute(f'PRAGMA user_version = {version}')
+
+    def add_lookup_indexes(self):
+        """
+        Index the login columns (unique) and created_at. Repeated rows left by
+        older versions are dropped first, keeping the earliest one, which is
+        the row the login lookups used to find
+        """
+
+        for column in ('email', 'telephone_number'):
+            self.cursor.execute(
+                f"""
+                DELETE FROM users
+                WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY {column})
+                """
+            )
+
+        self.cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email)'
+        )
+        self.cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS users_telephone_number ON users (telephone_number)'
+        )
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS users_created_at ON users (created_at)'
+        )
+
+    def add_ingested_files_table(self):
+        """Table remembering the data files already ingested, for incremental runs"""
+
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ingested_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                resume_offset INTEGER
+            )
+            """
+        )
+
+    def add_children_table(self):
+        """
+        Normalized copy of users.children, one row per child, indexed by age.
+        Children of existing users are copied from the JSON column
+        """
+
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS children (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+                name TEXT,
+                age INTEGER
+            )
+            """
+        )
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS children_user_id ON children (user_id)'
+        )
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS children_age ON children (age, user_id)'
+        )
+
+        # Children keep the order they have in the JSON column
+        self.cursor.execute(
+            """
+            INSERT INTO children (user_id, name, age)
+            SELECT users.id, json_extract(child.value, '$.name'), json_extract(child.value, '$.age')
+            FROM users, json_each(users.children) AS child
+            ORDER BY users.id, child.key
+            """
+        )
+        self.cursor.execute(
+            """
+            UPDATE children
+            SET age=CASE WHEN age GLOB '[0-9]*' AND age NOT GLOB '*[^0-9]*' THEN CAST(age AS INTEGER) END
+            """
+        )
+
+    def defer_password_hashing(self):
+        """
+        Nothing to change when the database is opened: hashing every stored password would hold
+        the write lock for as long as an ingest. The plaintext passwords left by older versions
+        are accepted by the logins until create_database hashes them (hash_plaintext_passwords)
+        """
+
+    def hash_plaintext_passwords(self):
+        """Replace the plaintext passwords left by older versions with salted hashes, batch by batch"""
+
+        self.cursor.execute(
+            """
+            SELECT id, password
+            FROM users
+            WHERE substr(password, 1, ?) != ?
+            """,
+            (len(HASH_PREFIX), HASH_PREFIX),
+        )
+        plaintext_users = self.cursor.fetchall()
+
+        for start in range(0, len(plaintext_users), BATCH_SIZE):
+            batch = plaintext_users[start : start + BATCH_SIZE]
+            password_hashes = hash_passwords([password for _, password in batch])
+            with self.connection:
+                self.cursor.executemany(
+                    """
+                    UPDATE users
+                    SET password=?
+                    WHERE id=?
                     """,
-                        (
-                            user['firstname'],
-                            fixed_phone_num,
-                            user['email'],
-                            user['password'],
-                            user['role'],
-                            user['created_at'],
-                            json.dumps(user['children']),
-                        ),
-                    )
-                    (self.connection.commit(),)
+                    [
+                        (password_hash, user_id)
+                        for (user_id, _), password_hash in zip(batch, password_hashes)
+                    ],
+                )
 
-                elif data_repeated == 'email_repeated':
-                    self.cursor.execute(
-                        """
-                        SELECT created_at
-                        FROM users
-                        WHERE email=?
-                        """,
-                        (user['email'],),
-                    )
-                    database_record_time = datetime.strptime(
-                        self.cursor.fetchone()[0], '%Y-%m-%d %H:%M:%S'
-                    )
+    def add_user_stats(self):
+        """
+        Single-row table with the number of users and the id of the oldest one,
+        so the admin summaries need no table scans. add_batch keeps it up to date
+        """
 
-                    database_record_time_difference = (
-                        current_system_time - database_record_time
-                    )
-                    current_user_time_difference = (
-                        current_system_time - current_user_time
-                    )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                user_count INTEGER NOT NULL,
+                oldest_user_id INTEGER
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            INSERT OR REPLACE INTO user_stats (id, user_count, oldest_user_id)
+            VALUES (0, (SELECT COUNT(1) FROM users), NULL)
+            """
+        )
+        self.update_oldest_user()
 
-                    if database_record_time_difference < current_user_time_difference:
-                        pass
-                    else:  # Newer record was found: replace the old one
-                        self.cursor.execute(
-                            """
-                            UPDATE users
-                            SET firstname=?, telephone_number=?, email=?, password=?, role=?, created_at=?, children=?
-                            WHERE email=?
-                            """,
-                            (
-                                user['firstname'],
-                                fixed_phone_num,
-                                user['email'],
-                                user['password'],
-                                user['role'],
-                                user['created_at'],
-                                json.dumps(user['children']),
-                                user['email'],
-                            ),
-                        )
-                    (self.connection.commit(),)
-
-                elif data_repeated == 'number_repeated':
-                    self.cursor.execute(
-                        """
-                            UPDATE users
-                            SET firstname=?, telephone_number=?, email=?, password=?, role=?, created_at=?, children=?
-                            WHERE telephone_number=?
-                            """,
-                        (
-                            user['firstname'],
-                            fixed_phone_num,
-                            user['email'],
-                            user['password'],
-                            user['role'],
-                            user['created_at'],
-                            json.dumps(user['children']),
-                            fixed_phone_num,
-                        ),
-                    )
-                    (self.connection.commit(),)
+    def update_oldest_user(self):
+        """
+        Remember the oldest user: the first one by (created_at, id), as ORDER BY created_at
+        reads them from the index. A single index lookup, done once per written batch
+        """
+
+        self.cursor.execute(
+            """
+            UPDATE user_stats
+            SET oldest_user_id=(SELECT id FROM users ORDER BY created_at, id LIMIT 1)
+            WHERE id = 0
+            """
+        )
+
+    def store_created_at_as_epoch(self):
+        """
+        Store created_at as integer seconds since the epoch instead of text, so comparing
+        and sorting creation times compares plain integers. It is formatted back on output.
+        The times are read by parse_time, as the ingest reads them; a time it rejects stops
+        the migration (ValueError) rather than being stored as NULL
+        """
+
+        self.cursor.execute(
+            """
+            SELECT id, created_at
+            FROM users
+            WHERE typeof(created_at)='text'
+            """
+        )
+        epoch_times = []
+        for user_id, created_at in self.cursor.fetchall():
+            try:
+                epoch_times.append((parse_time(created_at), user_id))
+            except ValueError:
+                raise ValueError(
+                    f'User {user_id} of {self.db_name} has an unreadable creation time: '
+                    f'{created_at!r}'
+                ) from None
+
+        self.cursor.executemany(
+            """
+            UPDATE users
+            SET created_at=?
+            WHERE id=?
+            """,
+            epoch_times,
+        )
+        self.update_oldest_user()
 
-    @classmethod
-    def validate_email(cls, email) -> bool:
-        """Check if the email meets the criteria in the tasks' Readme file"""
+    def write_batch(self, valid_users):
+        """Write the batch in a single transaction (and commit)"""
 
-        pattern = re.compile('^[A-Za-z\d\.\_\+\-]+@[A-Za-z\d\.\_]+\.[A-Za-z\d]{1,4}$')
+        with self.connection:
+            changed_ids = self.add_batch(valid_users)
+            with db_metrics.timer('commit'):
+                self.connection.commit()
 
-        if re.match(pattern, email):
-            return True
-        return False
+        return changed_ids
 
-    @classmethod
-    def validate_phone_num(cls, phone_num) -> bool:
+    def add_batch(self, valid_users):
         """
-        Check if the number after reformat can meet the criteria
-        i.e. no trailing zeros, 9-digits long
+        Resolve repetitions of the batch in memory, the same way as adding
+        the rows one by one would, and write the outcome with executemany.
+        Return the ids of the existing users that were changed or removed
         """
 
-        digits = re.sub(r'\D', '', phone_num)[-9:]
+        with db_metrics.timer('dedup_lookup'):
+            rows, email_index, phone_index = self.load_existing_rows(
+                {user.email for user, _, _ in valid_users},
+                {phone_num for _, phone_num, _ in valid_users},
+            )
+            first_new_id = next_id = self.next_user_id()
+
+        with db_metrics.timer('dedup_resolve'):
+            inserted_ids = []
+            updated_ids = set()
+            deleted_ids = set()
+            children_data = {}  # Children of the written rows, for the children table
+
+            for user, fixed_phone_num, current_user_time in valid_users:
+                record = (
+                    user.firstname,
+                    fixed_phone_num,
+                    user.email,
+                    user.password,
+                    user.role,
+                    current_user_time,
+                    json.dumps(children_as_dicts(user.children)),
+                )
+
+                if email_index.get(user.email):
+                    (row_id,) = email_index[user.email]
+                    if rows[row_id][5] > current_user_time:
+                        continue  # Record in the database is newer: keep it
+                elif phone_index.get(fixed_phone_num):
+                    (row_id,) = phone_index[fixed_phone_num]
+                else:  # No repetitions were found
+                    row_id = next_id
+                    inserted_ids.append(next_id)
+                    next_id += 1
+
+                # A newer record moving to a phone number owned by another user replaces that user,
+                # as the phone number has to stay unique
+                for replaced_id in phone_index.get(fixed_phone_num, set()) - {row_id}:
+                    self.replace_cached_row(rows, email_index, phone_index, replaced_id, None)
+                    deleted_ids.add(replaced_id)
+
+                self.replace_cached_row(rows, email_index, phone_index, row_id, record)
+                updated_ids.add(row_id)
+                children_data[row_id] = user.children
+
+            inserted_ids = [row_id for row_id in inserted_ids if row_id not in deleted_ids]
+            updated_ids -= deleted_ids.union(inserted_ids)
+            deleted_ids = {row_id for row_id in deleted_ids if row_id < first_new_id}
 
-        if len(digits) == 9:
-            return True
-        return False
+        # Only the rows actually written get their password hashed, in parallel
+        with db_metrics.timer('hash_passwords'):
+            written_ids = sorted(updated_ids) + inserted_ids
+            password_hashes = hash_passwords([rows[row_id][3] for row_id in written_ids])
+            for row_id, password_hash in zip(written_ids, password_hashes):
+                record = rows[row_id]
+                rows[row_id] = record[:3] + (password_hash,) + record[4:]
 
-    def check_if_data_is_repeated(self, user_data, phone_num):
-        """Check if the e-mail address or phone number was repeated when adding data to the database"""
+        with db_metrics.timer('write'):
+            self.cursor.executemany(
+                """
+                DELETE FROM users
+                WHERE id=?
+                """,
+                [(row_id,) for row_id in sorted(deleted_ids)],
+            )
+            # Clear the unique columns first, so rows swapping their e-mails or phone numbers
+            # do not collide while being updated one by one
+            self.cursor.executemany(
+                """
+                UPDATE users
+                SET telephone_number=NULL, email=NULL
+                WHERE id=?
+                """,
+                [(row_id,) for row_id in sorted(updated_ids)],
+            )
+            self.cursor.executemany(
+                """
+                UPDATE users
+                SET firstname=?, telephone_number=?, email=?, password=?, role=?, created_at=?, children=?
+                WHERE id=?
+                """,
+                [rows[row_id] + (row_id,) for row_id in sorted(updated_ids)],
+            )
+            self.cursor.executemany(
+                """
+                INSERT INTO users (firstname, telephone_number, email, password, role, created_at, children, id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [rows[row_id] + (row_id,) for row_id in inserted_ids],
+            )
+
+            # Keep the children table in step with the written rows
+            self.cursor.executemany(
+                """
+                DELETE FROM children
+                WHERE user_id=?
+                """,
+                [(row_id,) for row_id in sorted(deleted_ids.union(updated_ids))],
+            )
+            self.cursor.executemany(
+                """
+                INSERT INTO children (user_id, name, age)
+                VALUES (?, ?, ?)
+                """,
+                [
+                    (row_id, *child)
+                    for row_id in sorted(updated_ids) + inserted_ids
+                    for child in children_data[row_id]
+                ],
+            )
+
+            if next_id > first_new_id:  # Ids of rows replaced within the batch are not reused either
+                self.cursor.execute(
+                    """
+                    UPDATE sqlite_sequence
+                    SET seq=MAX(seq, ?)
+                    WHERE name='users'
+                    """,
+                    (next_id - 1,),
+                )
+
+            self.cursor.execute(
+                """
+                UPDATE user_stats
+                SET user_count=user_count + ?
+                WHERE id = 0
+                """,
+                (len(inserted_ids) - len(deleted_ids),),
+            )
+            self.update_oldest_user()
+
+        db_metrics.count('rows_inserted', len(inserted_ids))
+        db_metrics.count('rows_updated', len(updated_ids))
+        db_metrics.count('rows_deleted', len(deleted_ids))
+
+        return updated_ids.union(deleted_ids)
+
+    def load_existing_rows(self, emails, phone_nums):
+        """Fetch the rows sharing an e-mail or phone number with the batch, indexed by both"""
+
+        rows = {}
+        for column, values in (('email', list(emails)), ('telephone_number', list(phone_nums))):
+            for i in range(0, len(values), SQL_VARIABLES_LIMIT):
+                chunk = values[i : i + SQL_VARIABLES_LIMIT]
+                self.cursor.execute(
+                    f"""
+                    SELECT id, firstname, telephone_number, email, password, role, created_at, children
+                    FROM users
+                    WHERE {column} IN ({', '.join('?' * len(chunk))})
+                    """,
+                    chunk,
+                )
+                for row in self.cursor.fetchall():
+                    rows[row[0]] = row[1:]
+
+        email_index = defaultdict(set)
+        phone_index = defaultdict(set)
+        for row_id, row in rows.items():
+            email_index[row[2]].add(row_id)
+            phone_index[row[1]].add(row_id)
+
+        return rows, email_index, phone_index
+
+    @staticmethod
+    def replace_cached_row(rows, email_index, phone_index, row_id, record):
+        """Overwrite (or delete) a row of the in-memory batch state, keeping its indexes up to date"""
+
+        if row_id in rows:
+            email_index[rows[row_id][2]].discard(row_id)
+            phone_index[rows[row_id][1]].discard(row_id)
+
+        if record is None:  # The row is being deleted
+            rows.pop(row_id, None)
+            return
+
+        rows[row_id] = record
+        email_index[record[2]].add(row_id)
+        phone_index[record[1]].add(row_id)
+
+    def next_user_id(self):
+        """Return the id that AUTOINCREMENT would assign to the next inserted user"""
 
         self.cursor.execute(
-            """SELECT email
-                        FROM users
-                        WHERE email=?
-                        """,
-            (user_data['email'],),
+            """
+            SELECT MAX(
+                IFNULL((SELECT seq FROM sqlite_sequence WHERE name='users'), 0),
+                IFNULL((SELECT MAX(id) FROM users), 0)
+            )
+            """
+        )
+        return self.cursor.fetchone()[0] + 1
+
+    def find_user(self, column, value):
+        self.cursor.execute(
+            f"""
+            SELECT id, email, telephone_number, role, password
+            FROM users
+            WHERE {column}=?
+            """,
+            (value,),
+        )
+
+        return self.cursor.fetchone()
+
+    def count_users(self):
+        """Total number of valid accounts, counted in user_stats"""
+
+        self.cursor.execute(
+            """
+            SELECT user_count FROM user_stats
+            """
         )
 
+        return self.cursor.fetchone()[0]
+
+    def oldest_user(self):
+        """Name, e-mail address and creation time of the longest existing account, tracked in user_stats"""
+
+        self.cursor.execute(
+            """
+            SELECT firstname, email, created_at
+            FROM user_stats
+            JOIN users ON users.id = user_stats.oldest_user_id
+            """
+        )
         result = self.cursor.fetchone()
 
-        if result:
-            return 'email_repeated'
-        else:
-            self.cursor.execute(
-                """SELECT telephone_number
-                        FROM users
-                        WHERE telephone_number=?
-                        """,
-                (phone_num,),
+        if result is None:
+            return None
+        return {'name': result[0], 'email_address': result[1], 'created_at': format_time(result[2])}
+
+    def children_age_groups(self):
+        """
+        Number of children of every age, sorted by count (ascending). Counted inside SQLite,
+        using the index on children.age; ages with the same count keep the order they
+        first appear in (by user, then child)
+        """
+
+        self.cursor.execute(
+            """
+            SELECT age, count
+            FROM (
+                SELECT age, COUNT(1) AS count, MIN(user_id) AS first_user_id
+                FROM children
+                WHERE age IS NOT NULL
+                GROUP BY age
+            ) AS age_groups
+            ORDER BY count ASC, first_user_id ASC, (
+                SELECT MIN(id)
+                FROM children
+                WHERE age = age_groups.age AND user_id = age_groups.first_user_id
+            ) ASC
+            """
+        )
+
+        return [{'age': age, 'count': count} for age, count in self.cursor.fetchall()]
+
+    def user_children(self, user_id):
+        """Children of the user, sorted by name"""
+
+        self.cursor.execute(
+            """
+            SELECT name, age
+            FROM children
+            WHERE user_id=?
+            ORDER BY name, id
+            """,
+            (user_id,),
+        )
+
+        return [{'name': name, 'age': age} for name, age in self.cursor.fetchall()]
+
+    def similar_children_by_age(self, user_id):
+        """
+        Yield the other users having a child of the same age as any of the user's own children,
+        along with all their children sorted by name. Only the users sharing an age are
+        touched, found through the index on children.age
+        """
+
+        cursor = self.connection.cursor()  # Own cursor, as the rows are streamed lazily
+        cursor.execute(
+            """
+            SELECT users.id, users.firstname, users.telephone_number, children.name, children.age
+            FROM users
+            JOIN children ON children.user_id = users.id
+            WHERE users.id IN (
+                SELECT similar.user_id
+                FROM children AS own
+                JOIN children AS similar ON similar.age = own.age
+                WHERE own.user_id = ?
+            ) AND users.id != ?
+            ORDER BY users.id, children.name, children.id
+            """,
+            (user_id, user_id),
+        )
+
+        for _, rows in groupby(cursor, key=lambda row: row[0]):
+            rows = list(rows)
+            yield {
+                'firstname': rows[0][1],
+                'telephone_number': rows[0][2],
+                'children': [{'name': name, 'age': age} for *_, name, age in rows],
+            }
+
+    def users_with_children(self):
+        """
+        Yield (id, e-mail, firstname, telephone number, children) of every user by id, the
+        children as (name, age) pairs sorted by name, the way similar_children_by_age lists them.
+        Read in a single pass, for matching all the users at once
+        """
+
+        cursor = self.connection.cursor()  # Own cursor, as the rows are streamed lazily
+        cursor.execute(
+            """
+            SELECT users.id, users.email, users.firstname, users.telephone_number,
+                children.id, children.name, children.age
+            FROM users
+            LEFT JOIN children ON children.user_id = users.id
+            ORDER BY users.id, children.name, children.id
+            """
+        )
+
+        for _, rows in groupby(cursor, key=lambda row: row[0]):
+            rows = list(rows)
+            yield rows[0][0], rows[0][1], rows[0][2], rows[0][3], [
+                (name, age) for *_, child_id, name, age in rows if child_id is not None
+            ]
+
+    def iter_stored_users(self):
+        cursor = self.connection.cursor()  # Own cursor, as the rows are streamed lazily
+        cursor.execute(
+            """
+            SELECT users.id, users.firstname, users.telephone_number, users.email, users.password,
+                users.role, users.created_at, children.id, children.name, children.age
+            FROM users
+            LEFT JOIN children ON children.user_id = users.id
+            ORDER BY users.id, children.id
+            """
+        )
+
+        for _, rows in groupby(cursor, key=lambda row: row[0]):
+            rows = list(rows)
+            yield (
+                *rows[0][:7],
+                [Child(name, age) for *_, child_id, name, age in rows if child_id is not None],
             )
-            result = self.cursor.fetchone()
 
-            if result:
-                return 'number_repeated'
-            else:
-                return False
+    def restore_users(self, users, next_id):
+        """
+        Insert the users into the new database batch by batch, in a single transaction,
+        with their ids, password hashes and creation times. Nothing is validated or hashed
+        """
+
+        self.create_tables()
+        if self.count_users():
+            raise ValueError(f'{self.db_name} is not empty, users are restored into a new database')
+
+        users = iter(users)
+        with self.connection:
+            while batch := list(islice(users, BATCH_SIZE)):
+                with db_metrics.timer('write'):
+                    self.cursor.executemany(
+                        """
+                        INSERT INTO users (id, firstname, telephone_number, email, password, role, created_at, children)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        [
+                            (*user[:7], json.dumps(children_as_dicts(user[7])))
+                            for user in batch
+                        ],
+                    )
+                    self.cursor.executemany(
+                        """
+                        INSERT INTO children (user_id, name, age)
+                        VALUES (?, ?, ?)
+                        """,
+                        [(user[0], *child) for user in batch for child in user[7]],
+                    )
+                db_metrics.count('rows_inserted', len(batch))
+
+            self.cursor.execute(
+                """
+                UPDATE user_stats
+                SET user_count=(SELECT COUNT(1) FROM users)
+                WHERE id = 0
+                """
+            )
+            self.update_oldest_user()
+            # Ids of the users removed before the snapshot are not reused either
+            self.cursor.execute(
+                """
+                UPDATE sqlite_sequence
+                SET seq=MAX(seq, ?)
+                WHERE name='users'
+                """,
+                (next_id - 1,),
+            )
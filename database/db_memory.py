@@ -0,0 +1,316 @@
+from array import array
+from collections import defaultdict
+
+from . import db_metrics
+from .db_auth import hash_passwords
+from .db_records import make_user
+from .db_storage import BATCH_SIZE, Storage
+from .db_time import format_time
+
+
+def child_order(child):
+    """Sort key of children by name, missing names first, as SQLite orders NULLs"""
+
+    return child.name is not None, child.name
+
+
+class MemoryStorage(Storage):
+    """
+    The storage engine keeping the users in RAM, column by column: one list (an array for the
+    creation times) per field, indexed by id - 1, with hash indexes from e-mails and phone
+    numbers to ids and from children ages to the users having them. Removed users leave empty
+    slots, so ids are never reused, as with AUTOINCREMENT. Nothing is persisted: the store is
+    filled by create_database or add_data, and is not safe to read while it is being written
+    """
+
+    def __init__(self, sessions=None):
+        super().__init__(sessions)
+
+        self.firstnames = []
+        self.telephone_numbers = []
+        self.emails = []  # None in the slots of removed users
+        self.passwords = []
+        self.roles = []
+        self.created_at = array('q')  # Seconds since the epoch
+        self.children = []  # Lists of Child records, in the order of the data files
+
+        self.email_index = {}
+        self.phone_index = {}
+        self.age_index = defaultdict(set)  # Age -> ids of the users with a child of that age
+        self.summaries = {}  # Oldest user and age groups, computed once after every write
+
+    def create_database(
+        self,
+        batch_size=BATCH_SIZE,
+        data_directory=None,
+        manifest=None,
+        workers=None,
+        incremental=True,
+        shadow=False,
+    ):
+        """
+        Populate the store with every data file found in data_directory (the bundled data
+        by default) or listed in the manifest, parsed by the given number of worker processes.
+        Every file is ingested, as nothing is remembered between runs; ingesting a file again
+        leaves the users as they are, so incremental makes no difference. Neither does shadow:
+        MemoryPool keeps the readers out until the ingest is over
+        """
+
+        from .db_parser import DataParser  # Ingest only, kept out of the server's startup
+
+        with db_metrics.timer('find_sources'):
+            sources = DataParser.discover_sources(data_directory, manifest)
+
+        parsed_sources = DataParser.iter_sources(
+            [(path, format, 0) for path, format in sources], workers
+        )
+        for format, user_data in parsed_sources:
+            self.add_data(user_data, format=format, batch_size=batch_size)
+            db_metrics.count(f'files_ingested_{format}')
+
+    def write_batch(self, valid_users):
+        """Apply the batch user by user, hashing the passwords of the users written only"""
+
+        first_new_id = len(self.emails) + 1
+        written_ids = set()
+        deleted_ids = set()
+
+        with db_metrics.timer('write'):
+            for user, fixed_phone_num, current_user_time in valid_users:
+                row_id = self.email_index.get(user.email)
+                if row_id is not None:
+                    if self.created_at[row_id - 1] > current_user_time:
+                        continue  # Stored record is newer: keep it
+                else:
+                    row_id = self.phone_index.get(fixed_phone_num)
+
+                if row_id is None:  # No repetitions were found
+                    row_id = self.add_slot()
+
+                # A newer record moving to a phone number owned by another user replaces that user,
+                # as the phone number has to stay unique
+                replaced_id = self.phone_index.get(fixed_phone_num)
+                if replaced_id is not None and replaced_id != row_id:
+                    self.remove_row(replaced_id)
+                    written_ids.discard(replaced_id)
+                    deleted_ids.add(replaced_id)
+
+                self.remove_row(row_id)
+                self.write_row(row_id, user, fixed_phone_num, current_user_time)
+                written_ids.add(row_id)
+
+        with db_metrics.timer('hash_passwords'):
+            hashed_ids = sorted(written_ids)
+            password_hashes = hash_passwords(
+                [self.passwords[row_id - 1] for row_id in hashed_ids]
+            )
+            for row_id, password_hash in zip(hashed_ids, password_hashes):
+                self.passwords[row_id - 1] = password_hash
+
+        self.summaries.clear()
+
+        db_metrics.count('rows_inserted', sum(row_id >= first_new_id for row_id in written_ids))
+        db_metrics.count('rows_updated', sum(row_id < first_new_id for row_id in written_ids))
+        db_metrics.count('rows_deleted', sum(row_id < first_new_id for row_id in deleted_ids))
+
+        return {row_id for row_id in written_ids.union(deleted_ids) if row_id < first_new_id}
+
+    def add_slot(self):
+        """Append an empty slot to every column, returning the id of the new user"""
+
+        for column in (
+            self.firstnames, self.telephone_numbers, self.emails, self.passwords, self.roles
+        ):
+            column.append(None)
+        self.created_at.append(0)
+        self.children.append([])
+
+        return len(self.emails)
+
+    def write_row(self, row_id, user, fixed_phone_num, created_at):
+        """Fill the (empty) slot of the user, indexing it"""
+
+        position = row_id - 1
+
+        self.firstnames[position] = user.firstname
+        self.telephone_numbers[position] = fixed_phone_num
+        self.emails[position] = user.email
+        self.passwords[position] = user.password
+        self.roles[position] = user.role
+        self.created_at[position] = created_at
+        self.children[position] = list(user.children)
+
+        self.email_index[user.email] = row_id
+        self.phone_index[fixed_phone_num] = row_id
+        for child in user.children:
+            if child.age is not None:
+                self.age_index[child.age].add(row_id)
+
+    def remove_row(self, row_id):
+        """Empty the slot of the user, dropping it from the indexes"""
+
+        position = row_id - 1
+        if self.emails[position] is None:
+            return
+
+        del self.email_index[self.emails[position]]
+        del self.phone_index[self.telephone_numbers[position]]
+        for child in self.children[position]:
+            if child.age is not None:
+                self.age_index[child.age].discard(row_id)
+
+        self.firstnames[position] = None
+        self.telephone_numbers[position] = None
+        self.emails[position] = None
+        self.passwords[position] = None
+        self.roles[position] = None
+        self.children[position] = []
+
+    def find_user(self, column, value):
+        index = self.email_index if column == 'email' else self.phone_index
+        row_id = index.get(value)
+
+        if row_id is None:
+            return None
+
+        position = row_id - 1
+        return (
+            row_id,
+            self.emails[position],
+            self.telephone_numbers[position],
+            self.roles[position],
+            self.passwords[position],
+        )
+
+    def count_users(self):
+        """Total number of valid accounts, the size of the e-mail index"""
+
+        return len(self.email_index)
+
+    def oldest_user(self):
+        """Name, e-mail address and creation time of the longest existing account"""
+
+        if 'oldest_user' not in self.summaries:
+            self.summaries['oldest_user'] = min(
+                ((self.created_at[row_id - 1], row_id) for row_id in self.email_index.values()),
+                default=None,
+            )
+
+        if self.summaries['oldest_user'] is None:
+            return None
+
+        created_at, row_id = self.summaries['oldest_user']
+        return {
+            'name': self.firstnames[row_id - 1],
+            'email_address': self.emails[row_id - 1],
+            'created_at': format_time(created_at),
+        }
+
+    def children_age_groups(self):
+        """Number of children of every age, sorted by count (ascending), counted once per write"""
+
+        if 'age_groups' not in self.summaries:
+            counts = {}
+            first_seen = {}  # Age -> (user id, position among the user's children)
+
+            for row_id, children in enumerate(self.children, 1):
+                for position, child in enumerate(children):
+                    if child.age is None:
+                        continue
+                    counts[child.age] = counts.get(child.age, 0) + 1
+                    first_seen.setdefault(child.age, (row_id, position))
+
+            self.summaries['age_groups'] = [
+                {'age': age, 'count': counts[age]}
+                for age in sorted(counts, key=lambda age: (counts[age], first_seen[age]))
+            ]
+
+        return self.summaries['age_groups']
+
+    def user_children(self, user_id):
+        """Children of the user, sorted by name"""
+
+        return [
+            {'name': child.name, 'age': child.age}
+            for child in sorted(self.children[user_id - 1], key=child_order)
+        ]
+
+    def similar_children_by_age(self, user_id):
+        """
+        Yield the other users having a child of the same age as any of the user's own children,
+        along with all their children sorted by name. Only the users sharing an age are
+        touched, found through the age index
+        """
+
+        similar_ids = set()
+        for child in self.children[user_id - 1]:
+            similar_ids.update(self.age_index.get(child.age, ()))
+        similar_ids.discard(user_id)
+
+        for row_id in sorted(similar_ids):
+            yield {
+                'firstname': self.firstnames[row_id - 1],
+                'telephone_number': self.telephone_numbers[row_id - 1],
+                'children': self.user_children(row_id),
+            }
+
+    def users_with_children(self):
+        for row_id, email in enumerate(self.emails, 1):
+            if email is None:
+                continue
+
+            position = row_id - 1
+            children = sorted(self.children[position], key=child_order)
+            yield (
+                row_id,
+                email,
+                self.firstnames[position],
+                self.telephone_numbers[position],
+                [(child.name, child.age) for child in children],
+            )
+
+    def iter_stored_users(self):
+        for row_id, email in enumerate(self.emails, 1):
+            if email is None:
+                continue
+
+            position = row_id - 1
+            yield (
+                row_id,
+                self.firstnames[position],
+                self.telephone_numbers[position],
+                email,
+                self.passwords[position],
+                self.roles[position],
+                self.created_at[position],
+                list(self.children[position]),
+            )
+
+    def next_user_id(self):
+        return len(self.emails) + 1
+
+    def restore_users(self, users, next_id):
+        """Fill the slots of the users, and leave the slots of the removed ones empty"""
+
+        if self.email_index:
+            raise ValueError('The store is not empty, users are restored into an empty one')
+
+        restored = 0
+        for row_id, firstname, telephone_number, email, password, role, created_at, children in (
+            users
+        ):
+            while len(self.emails) < row_id:
+                self.add_slot()
+            self.write_row(
+                row_id,
+                make_user((firstname, telephone_number, email, password, role, None, children)),
+                telephone_number,
+                created_at,
+            )
+            restored += 1
+
+        while len(self.emails) < next_id - 1:
+            self.add_slot()
+
+        self.summaries.clear()
+        db_metrics.count('rows_inserted', restored)
@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter
+
+# Upper bounds (seconds) of the action latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_PREFIX = 'users_db'
+
+NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    Stage timers, event counters and action latency histograms. Stage times are exclusive:
+    while a nested stage runs (e.g. parsing, pulled by normalization), the enclosing one is paused.
+    Only what runs in this process is seen; with parallel parser workers the parse stages time
+    waiting for their output
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Stack of the running stages of every thread
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stage_seconds = {}
+            self.stage_calls = {}
+            self.counters = {}
+            self.latencies = {}  # Action name -> [bucket counts..., +Inf count, sum]
+
+    def add_stage_time(self, stage, seconds, calls):
+        with self.lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + calls
+
+    def start_stage(self, stage):
+        stack = self.local.__dict__.setdefault('stages', [])
+        now = perf_counter()
+
+        if stack:  # Pause the enclosing stage
+            self.add_stage_time(stack[-1][0], now - stack[-1][1], 0)
+        stack.append([stage, now])
+
+    def stop_stage(self):
+        stack = self.local.stages
+        now = perf_counter()
+
+        stage, started = stack.pop()
+        self.add_stage_time(stage, now - started, 1)
+        if stack:  # Resume the enclosing stage
+            stack[-1][1] = now
+
+    def count(self, event, number):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + number
+
+    def observe(self, action, seconds):
+        with self.lock:
+            histogram = self.latencies.setdefault(action, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+            histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'stages': {
+                    stage: {'seconds': seconds, 'calls': self.stage_calls[stage]}
+                    for stage, seconds in sorted(self.stage_seconds.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+                'actions': {
+                    action: {
+                        'buckets': dict(
+                            zip(
+                                [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                cumulative(histogram[:-1]),
+                            )
+                        ),
+                        'sum': histogram[-1],
+                        'count': sum(histogram[:-1]),
+                    }
+                    for action, histogram in sorted(self.latencies.items())
+                },
+            }
+
+    def prometheus_text(self):
+        """The metrics in the Prometheus text exposition format"""
+
+        metrics = self.as_dict()
+        lines = []
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_stage_seconds_total counter')
+        for stage, stats in metrics['stages'].items():
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_total{{stage="{stage}"}} {stats["seconds"]}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_stage_calls_total counter')
+        for stage, stats in metrics['stages'].items():
+            lines.append(f'{METRIC_PREFIX}_stage_calls_total{{stage="{stage}"}} {stats["calls"]}')
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_events_total counter')
+        for event, number in metrics['counters'].items():
+            lines.append(f'{METRIC_PREFIX}_events_total{{event="{event}"}} {number}')
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_action_seconds histogram')
+        for action, histogram in metrics['actions'].items():
+            for bound, number in histogram['buckets'].items():
+                lines.append(
+                    f'{METRIC_PREFIX}_action_seconds_bucket{{action="{action}",le="{bound}"}} {number}'
+                )
+            lines.append(f'{METRIC_PREFIX}_action_seconds_sum{{action="{action}"}} {histogram["sum"]}')
+            lines.append(f'{METRIC_PREFIX}_action_seconds_count{{action="{action}"}} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class StageTimer:
+    __slots__ = ('stage',)
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        registry.start_stage(self.stage)
+
+    def __exit__(self, *exc_info):
+        registry.stop_stage()
+
+
+def cumulative(counts):
+    total = 0
+    for number in counts:
+        total += number
+        yield total
+
+
+registry = Metrics()
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    registry.enabled = False
+
+
+def reset():
+    registry.reset()
+
+
+def timer(stage):
+    """Context manager adding the time spent inside to the stage; a shared no-op when disabled"""
+
+    if not registry.enabled:
+        return NULL_TIMER
+    return StageTimer(stage)
+
+
+def timed_iter(stage, iterable):
+    """The items of the iterable, with the time spent producing them added to the stage"""
+
+    if not registry.enabled:
+        return iterable
+    return timed_items(StageTimer(stage), iter(iterable))
+
+
+def timed_items(stage_timer, iterator):
+    while True:
+        with stage_timer:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(event, number=1):
+    """Add number to the event's counter"""
+
+    if registry.enabled:
+        registry.count(event, number)
+
+
+def timed_action(func):
+    """Decorator recording the latency of every call in the histogram of the function's name"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not registry.enabled:
+            return func(*args, **kwargs)
+
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            registry.observe(func.__name__, perf_counter() - started)
+
+    return wrapper
+
+
+def export(path):
+    """Write the metrics to the file, as JSON for a .json path and as Prometheus text otherwise"""
+
+    with open(path, 'w') as metrics_file:
+        if os.path.splitext(path)[1] == '.json':
+            metrics_file.write(json.dumps(registry.as_dict(), indent=2) + '\n')
+        else:
+            metrics_file.write(registry.prometheus_text())
@@ -1,11 +1,36 @@
 import json
 import csv
+import io
+import locale
+import mmap
 import re
 import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, chain, repeat
 from pathlib import Path
 
+from .db_records import User, child_age, make_child, make_user, user_from_dict
+
 manager_directory = Path(__file__).resolve().parent
 
+JSON_CHUNK_SIZE = 1 << 16  # Characters read at once by iter_json
+CSV_BLOCK_SIZE = 1 << 17  # Bytes decoded and split at once; small enough to stay in cache
+
+# Columns of the .csv files read by the fast path of iter_csv_rows, in any order
+CSV_FIELDS = User._fields
+
+# Formats of the data files, in the order they are ingested
+SOURCE_FORMATS = {".json": "json", ".csv": "csv", ".xml": "xml"}
+
+whitespace_regex = re.compile(r"\s*")
+number_regex = re.compile(r"(\d+)")
+name_regex = re.compile("[A-Za-z]*")
+age_regex = re.compile(r"\d+")
+# Lines of .csv children fields made of plain "name (age)" items, which can be split at once
+csv_children_field = r"(?:[A-Za-z]+ \(\d+\)(?:,[A-Za-z]+ \(\d+\))*)?"
+csv_children_column_regex = re.compile(rf"{csv_children_field}(?:\n{csv_children_field})*")
+
 
 class DataParser:
     """
@@ -18,24 +43,103 @@ class DataParser:
 
     @classmethod
     def convert_to_common_format(cls, data, source_format):
-        """Convert data so everything has the same formatting"""
-
-        common_data = []
+        """
+        Convert data so everything has the same formatting: User records. The records
+        yielded by iter_xml and iter_csv_rows are passed on as they are, only plain
+        dicts (.json objects) are converted. The items are yielded lazily, so the data
+        may be a generator, e.g. from iter_xml
+        """
 
         if source_format in ("json", "xml", "csv"):
             for user in data:
-                common_item = {
-                    "firstname": user["firstname"],
-                    "telephone_number": user["telephone_number"],
-                    "email": user["email"],
-                    "password": user["password"],
-                    "role": user["role"],
-                    "created_at": user["created_at"],
-                    "children": user.get("children", []),
-                }
-                common_data.append(common_item)
+                yield user if type(user) is User else user_from_dict(user)
 
-        return common_data
+    @classmethod
+    def discover_sources(cls, data_directory=None, manifest=None):
+        """
+        Return the (path, format) pairs of the data files to ingest, in the
+        order they are applied: either the files listed in the manifest
+        (one per line, relative to the manifest) or every data file in the
+        directory, .json first, then .csv and .xml, each sorted by name.
+        The paths are absolute: the readers take relative names as being under database/data
+        """
+
+        if manifest is not None:
+            manifest = Path(manifest)
+            paths = [
+                (manifest.parent / line.strip()).resolve()
+                for line in manifest.read_text().splitlines()
+                if line.strip() and not line.strip().startswith("#")
+            ]
+        else:
+            directory = Path(data_directory or manager_directory / "data").resolve()
+            formats_order = list(SOURCE_FORMATS)
+            paths = sorted(
+                (path for path in directory.iterdir() if path.suffix in SOURCE_FORMATS),
+                key=lambda path: (
+                    formats_order.index(path.suffix),
+                    # Natural order, so users_10 comes after users_2
+                    [int(part) if part.isdigit() else part for part in number_regex.split(path.name)],
+                ),
+            )
+
+        for path in paths:
+            if path.suffix.lower() not in SOURCE_FORMATS:
+                raise ValueError(f"Unsupported data file format: {path}")
+
+        return [(path, SOURCE_FORMATS[path.suffix.lower()]) for path in paths]
+
+    @classmethod
+    def iter_source(cls, path, source_format, offset=0):
+        """
+        Stream the users of a data file with the parser matching its format.
+        A .csv file may be read from a byte offset, to pick up appended rows only
+        """
+
+        if source_format == "csv":
+            return cls.iter_csv_rows(path, offset)
+
+        parsers = {"json": cls.iter_json, "xml": cls.iter_xml}
+
+        return parsers[source_format](path)
+
+    @classmethod
+    def parse_source(cls, path, source_format, offset=0):
+        """Parse the whole data file into a list (used by the worker processes)"""
+
+        return list(cls.iter_source(path, source_format, offset))
+
+    @classmethod
+    def iter_sources(cls, sources, workers=None):
+        """
+        Yield (source_format, users) for each of the (path, format, offset) sources,
+        in the given order. With several workers the files are parsed in a process
+        pool, a few files ahead of the consumer, and still handed over in order, so
+        the result of ingesting them stays the same as with serial parsing
+        """
+
+        if not workers or workers <= 1:
+            for path, source_format, offset in sources:
+                yield source_format, cls.iter_source(path, source_format, offset)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+
+            for path, source_format, offset in sources:
+                pending.append(
+                    (
+                        source_format,
+                        executor.submit(cls.parse_source, path, source_format, offset),
+                    )
+                )
+                if len(pending) > 2 * workers:  # Limit the parsed files waiting in memory
+                    source_format, future = pending.popleft()
+                    yield source_format, future.result()
+
+            while pending:
+                source_format, future = pending.popleft()
+                yield source_format, future.result()
 
     @classmethod
     def parse_json(cls, filename):
@@ -47,98 +151,276 @@ class DataParser:
 
             return json_data
 
+    @classmethod
+    def iter_json(cls, filename, chunk_size=JSON_CHUNK_SIZE):
+        """
+        Yield the objects of the top-level .json array one by one,
+        reading the file in chunks instead of loading it whole
+        """
+
+        path = manager_directory / "data" / filename
+        decoder = json.JSONDecoder()
+
+        with open(path, "r") as f:
+            buffer = ""
+            position = 0
+            end_of_file = False
+            array_opened = False
+
+            while True:
+                position = whitespace_regex.match(buffer, position).end()
+
+                if position < len(buffer):
+                    if not array_opened:
+                        if buffer[position] != "[":
+                            raise ValueError(f"{filename} does not hold a JSON array")
+                        array_opened = True
+                        position += 1
+                        continue
+                    if buffer[position] == "]":
+                        return
+                    if buffer[position] == ",":
+                        position += 1
+                        continue
+
+                    try:
+                        item, item_end = decoder.raw_decode(buffer, position)
+                    except json.JSONDecodeError:
+                        if end_of_file:
+                            raise
+                    else:
+                        # An item touching the end of the buffer may continue in the next chunk
+                        if item_end < len(buffer) or end_of_file:
+                            position = item_end
+                            yield item
+                            continue
+                elif end_of_file:
+                    raise ValueError(f"{filename} ended before the JSON array was closed")
+
+                chunk = f.read(chunk_size)
+                end_of_file = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+
     @classmethod
     def parse_xml(cls, filename):
-        path1 = manager_directory / "data" / f"{filename}1.xml"
-        path2 = manager_directory / "data" / f"{filename}2.xml"
-
-        xml_data1 = []
-        xml_data2 = []
-
-        tree1 = ET.parse(path1)
-        root1 = tree1.getroot()
-
-        tree2 = ET.parse(path2)
-        root2 = tree2.getroot()
-
-        roots_to_use = [root1, root2]
-        data_containers = [xml_data1, xml_data2]
-
-        for i in range(2):
-            for user in roots_to_use[i].findall("user"):
-                user_data = {}
-                user_data["firstname"] = user.find("firstname").text
-                user_data["telephone_number"] = user.find("telephone_number").text
-                user_data["email"] = user.find("email").text
-                user_data["password"] = user.find("password").text
-                user_data["role"] = user.find("role").text
-                user_data["created_at"] = user.find("created_at").text
-
-                if (
-                    user.findall(".//child") == []
-                ):  # Set children list empty when no child was found
-                    user_data["children"] = []
-                else:
-                    for child in user.findall(".//child"):
-                        child_data = {}
-                        child_data["name"] = child.findtext("name")
-                        child_data["age"] = child.findtext("age")
-                        user_data["children"] = user_data.get("children", []) + [
-                            child_data
-                        ]
-                data_containers[i].append(user_data)
+        xml_data1 = list(cls.iter_xml(f"{filename}1.xml"))
+        xml_data2 = list(cls.iter_xml(f"{filename}2.xml"))
 
         return xml_data1, xml_data2
 
     @classmethod
-    def parse_csv(cls, filename):
-        path1 = manager_directory / "data" / f"{filename}1.csv"
-        path2 = manager_directory / "data" / f"{filename}2.csv"
-
-        csv_data1 = []
-        csv_data2 = []
-
-        name_regex = re.compile("[A-Za-z]*")
-        age_regex = re.compile("\d+")
-
-        # Parse 1st csv file
-        with open(path1, "r") as csv1:
-            reader1 = csv.DictReader(csv1, delimiter=";")
-            for row in reader1:
-                children_data = []
-                row["children"] = cls.parse_children(row.get("children", ""))
-                for child in row[
-                    "children"
-                ]:  # Make .csv children data have the same formatting as data in .xml, .json files
-                    children_data.append(
-                        {
-                            "name": "".join(re.findall(name_regex, child)),
-                            "age": "".join(re.findall(age_regex, child)),
-                        }
-                    )
-                row["children"] = children_data
-
-                csv_data1.append(row)
-
-        # Parse 2nd csv file
-        with open(path2, "r") as csv2:
-            reader2 = csv.DictReader(csv2, delimiter=";")
-            for row in reader2:
-                children_data = []
-                row["children"] = cls.parse_children(row.get("children", ""))
-                for child in row["children"]:
-                    children_data.append(
-                        {
-                            "name": "".join(re.findall(name_regex, child)),
-                            "age": "".join(re.findall(age_regex, child)),
-                        }
-                    )
-                row["children"] = children_data
+    def iter_xml(cls, filename):
+        """
+        Yield the users of the .xml file one by one, freeing every parsed
+        <user> element, so memory use does not grow with the file size
+        """
+
+        path = manager_directory / "data" / filename
 
-                csv_data2.append(row)
+        context = ET.iterparse(path, events=("start", "end"))
+        _, root = next(context)  # <users> element, holding the parsed <user> elements
+
+        for event, element in context:
+            if event != "end" or element.tag != "user":
+                continue
+
+            user_data = User(
+                element.find("firstname").text,
+                element.find("telephone_number").text,
+                element.find("email").text,
+                element.find("password").text,
+                element.find("role").text,
+                element.find("created_at").text,
+                [
+                    make_child((child.findtext("name"), child_age(child.findtext("age"))))
+                    for child in element.iterfind(".//child")
+                ],
+            )
+
+            root.clear()  # Drop the finished <user> elements
+            yield user_data
+
+    @classmethod
+    def parse_csv(cls, filename):
+        csv_data1 = list(cls.iter_csv(f"{filename}1.csv"))
+        csv_data2 = list(cls.iter_csv(f"{filename}2.csv"))
 
         return csv_data1, csv_data2
 
+    @classmethod
+    def iter_csv(cls, filename, offset=0):
+        """
+        Yield the rows of the .csv file one by one. With an offset, only the
+        rows starting at that byte position (at the start of a line) are read
+        """
+
+        path = manager_directory / "data" / filename
+
+        with open(path, "rb") as binary_file:
+            fieldnames = None
+
+            header = binary_file.readline()
+            if offset > len(header):
+                fieldnames = next(csv.reader([header.decode()], delimiter=";"))
+                binary_file.seek(offset)
+            else:
+                binary_file.seek(0)
+
+            csv_file = io.TextIOWrapper(binary_file)
+            reader = csv.DictReader(csv_file, fieldnames=fieldnames, delimiter=";")
+            for row in reader:
+                # Make .csv children data have the same formatting as data in .xml, .json files
+                row["children"] = [
+                    {
+                        "name": "".join(re.findall(name_regex, child)),
+                        "age": "".join(re.findall(age_regex, child)),
+                    }
+                    for child in cls.parse_children(row.get("children", ""))
+                ]
+
+                yield row
+
+    @classmethod
+    def iter_csv_rows(cls, filename, offset=0):
+        """
+        Iterate over the rows of the .csv file as User records: the data iter_csv yields
+        as dicts, several times faster. The file
+        is memory-mapped and decoded a block at a time; the lines of a block are split into
+        columns at once and its children column is parsed in a single pass
+        """
+
+        return chain.from_iterable(cls.iter_csv_blocks(filename, offset))
+
+    @classmethod
+    def iter_csv_blocks(cls, filename, offset=0):
+        """
+        Yield the rows of the .csv file block by block. From the first block the fast split
+        cannot handle (quoted values, NUL bytes, bare carriage returns) on, and for files
+        with other columns, the rows are read by iter_csv
+        """
+
+        path = manager_directory / "data" / filename
+
+        with open(path, "rb") as binary_file:
+            header = binary_file.readline()
+            encoding = locale.getpreferredencoding(False)  # As io.TextIOWrapper in iter_csv
+            fieldnames = header.decode(encoding).rstrip("\r\n").split(";")
+
+            if sorted(fieldnames) != sorted(CSV_FIELDS):
+                yield cls.iter_csv_as_rows(filename, offset)
+                return
+
+            position = max(offset, len(header))
+            size = binary_file.seek(0, io.SEEK_END)
+            if position >= size:
+                return
+
+            with mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while position < size:
+                    end = min(position + CSV_BLOCK_SIZE, size)
+                    if end < size:  # Decode whole lines only
+                        end = (
+                            data.rfind(b"\n", position, end) + 1 or data.find(b"\n", end) + 1 or size
+                        )
+
+                    block = data[position:end].decode(encoding)
+                    if '"' in block or "\x00" in block or block.count("\r") != block.count("\r\n"):
+                        yield cls.iter_csv_as_rows(filename, position)
+                        return
+
+                    position = end
+                    yield cls.split_csv_block(block.replace("\r\n", "\n"), fieldnames)
+
+    @classmethod
+    def split_csv_block(cls, block, fieldnames):
+        """The rows of a block of whole .csv lines, as iter_csv_rows yields them"""
+
+        columns_count = len(fieldnames)
+        value_columns = [fieldnames.index(field) for field in CSV_FIELDS[:-1]]
+        children_column = fieldnames.index("children")
+
+        lines = block.split("\n")
+        if "" in lines:  # Blank lines are skipped, as by csv.DictReader
+            lines = [line for line in lines if line]
+
+        if set(map(str.count, lines, repeat(";"))) == {columns_count - 1}:
+            if block.endswith("\n") and len(lines) == block.count("\n"):
+                # Every line ends with a newline, and none of them was blank
+                values = block.replace("\n", ";").split(";")[:-1]
+            else:
+                values = ";".join(lines).split(";")
+            columns = [values[column::columns_count] for column in range(columns_count)]
+
+            return map(
+                make_user,
+                zip(
+                    *[columns[column] for column in value_columns],
+                    cls.parse_csv_children_column(columns[children_column]),
+                ),
+            )
+
+        rows = []
+        for line in lines:
+            values = line.split(";")
+            if len(values) < columns_count:  # Missing values are None, as in csv.DictReader
+                values += [None] * (columns_count - len(values))
+
+            rows.append(
+                User(
+                    *[values[column] for column in value_columns],
+                    cls.parse_csv_children(values[children_column]),
+                )
+            )
+
+        return rows
+
+    @classmethod
+    def parse_csv_children_column(cls, children_strings):
+        """
+        The children of every field of a .csv children column. When all the fields are plain
+        "name (age),..." lists, the whole column is checked by one regex call and split at once
+        """
+
+        column = "\n".join(children_strings)
+
+        if not csv_children_column_regex.fullmatch(column):
+            return map(cls.parse_csv_children, children_strings)
+
+        # "Anna (18),Mindy (11)\n\nGeorge (14)" -> Anna, 18, Mindy, 11, George, 14
+        items = list(
+            filter(None, column.replace(" (", ",").replace(")", "").replace("\n", ",").split(","))
+        )
+        children = list(map(make_child, zip(items[0::2], map(int, items[1::2]))))
+
+        ends = list(accumulate(map(str.count, children_strings, repeat("("))))
+        starts = [0] + ends[:-1]
+
+        return map(children.__getitem__, map(slice, starts, ends))
+
+    @classmethod
+    def iter_csv_as_rows(cls, filename, offset=0):
+        """The rows of iter_csv as User records"""
+
+        return map(user_from_dict, cls.iter_csv(filename, offset))
+
+    @classmethod
+    def parse_csv_children(cls, children_string):
+        """The children of a .csv children field, as iter_csv reads them"""
+
+        if not children_string:
+            return []
+
+        return [
+            make_child(
+                (
+                    "".join(re.findall(name_regex, child)),
+                    child_age("".join(re.findall(age_regex, child))),
+                )
+            )
+            for child in cls.parse_children(children_string)
+        ]
+
     @classmethod
     def parse_children(cls, children_string):
         """Split the comma-separated string into a list of individual children data"""
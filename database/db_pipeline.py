@@ -0,0 +1,58 @@
+import queue
+import threading
+from itertools import islice
+
+PREFETCH_SIZE = 5000  # Parsed items allowed to wait for the writer
+CHUNK_SIZE = 256  # Items handed over to the consumer at once
+
+_DONE = object()  # Marks the end of the source iterable
+
+
+def prefetch(iterable, max_items=PREFETCH_SIZE):
+    """
+    Consume the iterable in a background thread, handing the items over
+    through a bounded queue. Parsing keeps running while the consumer
+    writes to the database, and blocks when max_items are waiting (backpressure)
+    """
+
+    chunk_size = max(1, min(CHUNK_SIZE, max_items))
+    chunks = queue.Queue(maxsize=max(1, max_items // chunk_size))
+    stopped = threading.Event()
+
+    def put(chunk):
+        while not stopped.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            while True:
+                chunk = list(islice(iterator, chunk_size))
+                if not chunk:
+                    break
+                if not put((chunk, None)):
+                    return  # The consumer has gone away
+        except BaseException as error:  # Re-raised on the consumer's side
+            put((_DONE, error))
+        else:
+            put((_DONE, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            chunk, error = chunks.get()
+            if error is not None:
+                raise error
+            if chunk is _DONE:
+                break
+            yield from chunk
+    finally:
+        stopped.set()
+        producer.join()
@@ -0,0 +1,107 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .db_auth import SessionCache
+from .db_manager import DataHandler
+from .db_memory import MemoryStorage
+
+POOL_SIZE = 8  # Read connections kept open at most
+
+
+class ConnectionPool:
+    """
+    Connections shared by the requests of a long-running process: a pool of
+    read-only connections and a single writer, with the database in WAL mode,
+    so readers are not blocked while the writer works
+    """
+
+    def __init__(self, db_name, size=POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+
+        self.sessions = SessionCache()  # Shared, so the writer invalidates what readers cached
+        self.writer_handler = DataHandler(db_name, self.connect(), self.sessions)
+        self.writer_lock = threading.Lock()
+
+        self.readers = queue.LifoQueue()  # Idle read handlers, most recently used first
+        self.readers_count = 0
+        self.readers_lock = threading.Lock()
+
+    def connect(self, read_only=False):
+        """Open a connection that may be handed over between threads"""
+
+        connection = sqlite3.connect(self.db_name, check_same_thread=False)
+        if read_only:
+            connection.execute('PRAGMA query_only=ON')
+        else:
+            connection.execute('PRAGMA journal_mode=WAL').fetchone()
+
+        return connection
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only DataHandler, waiting for one when all of them are in use"""
+
+        try:
+            handler = self.readers.get_nowait()
+        except queue.Empty:
+            with self.readers_lock:
+                open_new = self.readers_count < self.size
+                if open_new:
+                    self.readers_count += 1
+
+            if open_new:
+                handler = DataHandler(
+                    self.db_name, self.connect(read_only=True), self.sessions
+                )
+            else:
+                handler = self.readers.get()
+
+        try:
+            # All the queries of a request see the same snapshot; the next borrower a fresh one
+            with handler.read_snapshot():
+                yield handler
+        finally:
+            self.readers.put(handler)
+
+    @contextmanager
+    def writer(self):
+        """Get the only DataHandler allowed to write, one user at a time"""
+
+        with self.writer_lock:
+            yield self.writer_handler
+
+    def close(self):
+        """Close the writer and the idle read connections"""
+
+        with self.writer_lock:
+            self.writer_handler.connection.close()
+
+        while True:
+            try:
+                self.readers.get_nowait().connection.close()
+            except queue.Empty:
+                break
+
+
+class MemoryPool:
+    """
+    The ConnectionPool interface over a single MemoryStorage, for serving the actions from RAM.
+    Readers and the writer take turns, as the store must not be read while it changes
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or MemoryStorage()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def reader(self):
+        with self.lock:
+            yield self.storage
+
+    writer = reader
+
+    def close(self):
+        pass
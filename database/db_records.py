@@ -0,0 +1,45 @@
+from collections import namedtuple
+from functools import partial
+
+# Records passed through the ingest pipeline. Named tuples have no per-instance __dict__,
+# so a user takes a fraction of the memory of a dict with the same 7 keys
+User = namedtuple(
+    'User', ['firstname', 'telephone_number', 'email', 'password', 'role', 'created_at', 'children']
+)
+Child = namedtuple('Child', ['name', 'age'])  # The age is an int, or None when malformed
+
+# Build records from tuples of their fields with no Python-level call per record,
+# for the parsers creating them by the thousand
+make_user = partial(tuple.__new__, User)
+make_child = partial(tuple.__new__, Child)
+
+
+def child_age(age):
+    """Age of a child as an integer (None when it is missing or malformed)"""
+
+    if type(age) is int:
+        return age
+
+    age = str(age).strip()
+
+    return int(age) if age.isdecimal() else None
+
+
+def user_from_dict(user):
+    """User record of a user given as a dict with the keys of the data files (children optional)"""
+
+    return User(
+        user['firstname'],
+        user['telephone_number'],
+        user['email'],
+        user['password'],
+        user['role'],
+        user['created_at'],
+        [Child(child['name'], child_age(child['age'])) for child in user.get('children', [])],
+    )
+
+
+def children_as_dicts(children):
+    """Children as they are stored in the users.children JSON column"""
+
+    return [{'name': name, 'age': age} for name, age in children]
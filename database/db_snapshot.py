@@ -0,0 +1,284 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+from . import db_metrics
+from .db_records import Child
+
+# Layout of a snapshot file, all numbers little-endian:
+#   header: magic, format version, CRC-32 of everything after the header, number of users,
+#           number of children and the id the next new user would get
+#   section table: (offset, size) of every section in SECTIONS, in that order (version 1 files
+#                  stop before FILE_SECTIONS, the data files the users were ingested from)
+#   sections: each starting at a multiple of 8 bytes. Number columns are plain arrays; a string
+#             column is a null mask (a byte per value), the end offsets of the values (uint32)
+#             and the UTF-8 text of all the values one after another
+MAGIC = b'USRSNAP\x00'
+VERSION = 2
+HEADER = struct.Struct('<8sIIqqq')
+SECTION = struct.Struct('<qq')
+
+STRING_COLUMNS = ('firstname', 'telephone_number', 'email', 'password', 'role')
+FILE_STRING_COLUMNS = ('file_name', 'file_sha256')
+FILE_SECTIONS = (
+    *(
+        (f'{column}_{part}', typecode)
+        for column in FILE_STRING_COLUMNS
+        for part, typecode in (('null', 'B'), ('end', 'I'), ('text', 'B'))
+    ),
+    ('file_size', 'q'),
+    ('file_resume_offset', 'q'),
+)
+SECTIONS = (
+    ('user_id', 'q'),
+    ('created_at', 'q'),  # Seconds since the epoch
+    ('children_end', 'I'),  # Position after the user's last child in the children columns
+    *(
+        (f'{column}_{part}', typecode)
+        for column in STRING_COLUMNS + ('child_name',)
+        for part, typecode in (('null', 'B'), ('end', 'I'), ('text', 'B'))
+    ),
+    ('child_age', 'q'),
+    *FILE_SECTIONS,
+)
+SECTIONS_COUNT = {1: len(SECTIONS) - len(FILE_SECTIONS), VERSION: len(SECTIONS)}
+SECTION_INDEX = {name: index for index, (name, _) in enumerate(SECTIONS)}
+NO_AGE = -(1 << 63)  # Stored in place of the malformed (None) ages
+
+STRING_COLUMN_LIMIT = 1 << 32  # Bytes of a string column, so its offsets fit in 32 bits
+
+
+def as_little_endian(values):
+    """Bytes of the array, little-endian whatever the byte order of the machine"""
+
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def string_column(values):
+    """null mask, end offsets and text sections of a column of strings (or None)"""
+
+    encoded = [b'' if value is None else value.encode() for value in values]
+    ends = list(accumulate(map(len, encoded)))
+
+    if ends and ends[-1] >= STRING_COLUMN_LIMIT:
+        raise ValueError('A column is too large for a snapshot')
+
+    return (
+        bytes(value is None for value in values),
+        as_little_endian(array('I', ends)),
+        b''.join(encoded),
+    )
+
+
+def export_snapshot(storage, path):
+    """
+    Write every user of the store, as it is stored (passwords hashed, creation times as
+    integers), and the data files it was ingested from to a snapshot file. Columns are written
+    one after another, so a loader reads each of them with a single copy. The file is replaced
+    at once, never left half-written
+    """
+
+    columns = {name: [] for name in ('user_id', 'created_at', 'children_end', 'child_name')}
+    columns.update({column: [] for column in STRING_COLUMNS})
+    child_ages = array('q')
+
+    with db_metrics.timer('snapshot_read'):
+        for user_id, firstname, telephone_number, email, password, role, created_at, children in (
+            storage.iter_stored_users()
+        ):
+            columns['user_id'].append(user_id)
+            columns['created_at'].append(created_at)
+            for column, value in zip(
+                STRING_COLUMNS, (firstname, telephone_number, email, password, role)
+            ):
+                columns[column].append(value)
+
+            for name, age in children:
+                columns['child_name'].append(name)
+                child_ages.append(NO_AGE if age is None else age)
+            columns['children_end'].append(len(child_ages))
+
+        files = list(storage.iter_ingested_files())
+
+    with db_metrics.timer('snapshot_encode'):
+        sections = [
+            as_little_endian(array('q', columns['user_id'])),
+            as_little_endian(array('q', columns['created_at'])),
+            as_little_endian(array('I', columns['children_end'])),
+        ]
+        for column in STRING_COLUMNS + ('child_name',):
+            sections.extend(string_column(columns[column]))
+        sections.append(as_little_endian(child_ages))
+        names, hashes, sizes, resume_offsets = zip(*files) if files else ((), (), (), ())
+        sections.extend(string_column(names))
+        sections.extend(string_column(hashes))
+        sections.append(as_little_endian(array('q', sizes)))
+        sections.append(as_little_endian(array('q', resume_offsets)))
+
+        offset = HEADER.size + SECTION.size * len(SECTIONS)
+        table = []
+        body = []
+        for section in sections:
+            padding = -offset % 8
+            body.append(b'\x00' * padding)
+            offset += padding
+            table.append(SECTION.pack(offset, len(section)))
+            body.append(section)
+            offset += len(section)
+
+        payload = b''.join(table + body)
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            zlib.crc32(payload),
+            len(columns['user_id']),
+            len(child_ages),
+            storage.next_user_id(),
+        )
+
+    with db_metrics.timer('snapshot_write'):
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(header)
+            snapshot_file.write(payload)
+        os.replace(temporary_path, path)
+
+    db_metrics.count('snapshot_users', len(columns['user_id']))
+
+
+class Snapshot:
+    """
+    A snapshot file mapped into memory. The header is checked on opening, and the columns
+    are read straight from the mapping, with no parsing or validation of the users
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            try:
+                self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # An empty file cannot be mapped
+                raise ValueError(f'{path} is not a snapshot file') from None
+
+        try:
+            self.read_header(path)
+        except BaseException:
+            self.map.close()
+            raise
+
+    def read_header(self, path):
+        if len(self.map) < HEADER.size or self.map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+
+        _, version, checksum, self.users_count, self.children_count, self.next_id = (
+            HEADER.unpack_from(self.map)
+        )
+        if version not in SECTIONS_COUNT:
+            raise ValueError(f'{path} has snapshot version {version}, {VERSION} is supported')
+        self.version = version
+
+        with memoryview(self.map) as view:
+            if zlib.crc32(view[HEADER.size :]) != checksum:
+                raise ValueError(f'{path} is damaged (checksum mismatch)')
+
+        self.sections = [
+            SECTION.unpack_from(self.map, HEADER.size + SECTION.size * index)
+            for index in range(SECTIONS_COUNT[version])
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    def section(self, name):
+        """Bytes of the section, copied out of the mapping"""
+
+        offset, size = self.sections[SECTION_INDEX[name]]
+        return self.map[offset : offset + size]
+
+    def column(self, name):
+        """Number column as an array"""
+
+        values = array(SECTIONS[SECTION_INDEX[name]][1], self.section(name))
+        if sys.byteorder == 'big':
+            values.byteswap()
+
+        return values
+
+    def strings(self, column):
+        """String column as a list, None where the mask says so"""
+
+        nulls = self.section(f'{column}_null')
+        ends = self.column(f'{column}_end')
+        text = self.section(f'{column}_text')
+        starts = [0, *ends[:-1]]
+
+        decoded = text.decode()
+        if len(decoded) == len(text):  # All ASCII: the byte offsets are character offsets too
+            values = [decoded[start:end] for start, end in zip(starts, ends)]
+        else:
+            values = [text[start:end].decode() for start, end in zip(starts, ends)]
+
+        if any(nulls):
+            values = [None if null else value for value, null in zip(values, nulls)]
+
+        return values
+
+    def iter_users(self):
+        """
+        Yield (id, firstname, telephone number, e-mail, password hash, role, creation time,
+        children) of every user by id, the way Storage.iter_stored_users does
+        """
+
+        names = self.strings('child_name')
+        ages = [None if age == NO_AGE else age for age in self.column('child_age')]
+        children = list(map(Child, names, ages))
+        ends = self.column('children_end')
+
+        yield from zip(
+            self.column('user_id'),
+            *map(self.strings, STRING_COLUMNS),
+            self.column('created_at'),
+            (children[start:end] for start, end in zip([0, *ends[:-1]], ends)),
+        )
+
+    def iter_files(self):
+        """
+        Yield (file name, sha256, size, resume offset) of the data files the users were
+        ingested from, the way Storage.iter_ingested_files does; none for a version 1 file
+        """
+
+        if self.version == 1:
+            return
+
+        yield from zip(
+            *map(self.strings, FILE_STRING_COLUMNS),
+            self.column('file_size'),
+            self.column('file_resume_offset'),
+        )
+
+
+def load_snapshot(path, storage):
+    """
+    Restore the users of a snapshot file into an empty store (a new database file or an
+    empty MemoryStorage), with the ids, password hashes and creation times they had, along
+    with the data files they were ingested from
+    """
+
+    with db_metrics.timer('snapshot_load'), Snapshot(path) as snapshot:
+        storage.restore_users(snapshot.iter_users(), snapshot.next_id)
+        storage.restore_ingested_files(snapshot.iter_files())
+
+    db_metrics.count('snapshot_users', snapshot.users_count)
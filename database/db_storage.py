@@ -0,0 +1,265 @@
+import re
+from abc import ABC, abstractmethod
+from itertools import islice
+
+from . import db_metrics
+from .db_auth import Session, SessionCache, verify_password
+from .db_time import parse_time
+
+BATCH_SIZE = 5000  # Rows written per transaction by add_data
+VALIDATION_CHUNK_SIZE = 1024  # Users validated together by validate_batch
+
+email_regex = re.compile(r'^[A-Za-z\d\.\_\+\-]+@[A-Za-z\d\.\_]+\.[A-Za-z\d]{1,4}$')
+non_digit_regex = re.compile(r'\D')
+
+
+class Storage(ABC):
+    """
+    Store of the users behind the script.py actions. The validation, the ingest pipeline
+    and the authentication are shared; the storage engines write the validated batches
+    and answer the queries of the actions: DataHandler in a SQLite database file,
+    MemoryStorage in RAM
+    """
+
+    def __init__(self, sessions=None):
+        self.sessions = sessions or SessionCache()
+
+    @abstractmethod
+    def create_database(
+        self,
+        batch_size=BATCH_SIZE,
+        data_directory=None,
+        manifest=None,
+        workers=None,
+        incremental=True,
+        shadow=False,
+    ):
+        """
+        Populate the store with the data files in data_directory or listed in the manifest.
+        With shadow, readers keep seeing the previous users until the whole ingest is applied
+        """
+
+    def add_data(self, user_data, format, batch_size=BATCH_SIZE, rejected=None):
+        """
+        Verify the provided data and then, add it to the database batch by batch.
+        The data is pulled lazily through parse -> normalize -> validate -> write,
+        with at most about two batches held in memory at once. The users failing
+        validation are appended to the rejected list, if given, with their reasons
+        """
+
+        # Ingest only: the parsers and their xml, csv and multiprocessing imports are loaded
+        # on the first write, not by every query action
+        from .db_parser import DataParser
+        from .db_pipeline import prefetch
+
+        user_data = db_metrics.timed_iter(f'parse_{format}', user_data)
+        common_data = db_metrics.timed_iter(
+            'normalize', DataParser.convert_to_common_format(user_data, format)
+        )
+        valid_users = self.filter_valid_users(prefetch(common_data, batch_size), rejected)
+
+        while True:
+            batch = list(islice(valid_users, batch_size))
+            if not batch:
+                break
+
+            changed_ids = self.write_batch(batch)
+            self.sessions.invalidate(changed_ids)
+
+    @abstractmethod
+    def write_batch(self, valid_users):
+        """
+        Write a batch of (user, fixed phone number, creation time) as a whole. A user repeating
+        the e-mail of a stored one overwrites it, unless the stored record is newer; otherwise
+        one repeating a phone number overwrites the user owning it. Return the ids of the
+        existing users that were changed or removed
+        """
+
+    def filter_valid_users(self, users, rejected=None):
+        """
+        Yield the users meeting all criteria, along with their fixed phone number and creation time
+        (seconds since the epoch).
+        Users are validated in chunks; the rejected ones are added to the rejected list as
+        (user, reasons), if it is given
+        """
+
+        users = iter(users)
+
+        while chunk := list(islice(users, VALIDATION_CHUNK_SIZE)):
+            with db_metrics.timer('validate'):
+                valid_mask, fixed_phone_nums, rejected_rows = self.validate_batch(
+                    [user.email for user in chunk],
+                    [user.telephone_number for user in chunk],
+                )
+                valid_users = [
+                    (user, fixed_phone_num, parse_time(user.created_at))
+                    for user, is_valid, fixed_phone_num in zip(chunk, valid_mask, fixed_phone_nums)
+                    if is_valid
+                ]
+
+            db_metrics.count('users_valid', len(valid_users))
+            for _, reasons in rejected_rows:
+                for reason in reasons:
+                    db_metrics.count(f'users_rejected_{reason}')
+            if rejected is not None:
+                rejected.extend((chunk[row], reasons) for row, reasons in rejected_rows)
+
+            yield from valid_users
+
+    def authenticate_user(self, login, password):
+        """
+        Return the Session of the user the login (e-mail or phone number) and password belong to,
+        or None. The user is found with a single indexed lookup, and verified logins are
+        served from the session cache without asking the store again
+        """
+
+        if login is None or password is None:
+            return None
+
+        session = self.sessions.get(login, password)
+        if session is not None:
+            return session
+
+        if self.validate_email(login):  # The case in which an e-mail was provided as Login
+            column, value = 'email', login
+        elif self.validate_phone_num(login):  # The case in which a telephone number was provided
+            column, value = 'telephone_number', self.fix_phone_num(login)
+        else:
+            return None
+
+        result = self.find_user(column, value)
+
+        if result is None or not verify_password(password, result[4]):
+            return None
+
+        session = Session(*result[:4])
+        self.sessions.add(login, password, session)
+
+        return session
+
+    @abstractmethod
+    def find_user(self, column, value):
+        """
+        (id, email, telephone_number, role, password hash) of the user whose column
+        ('email' or 'telephone_number') holds the value, or None
+        """
+
+    @abstractmethod
+    def count_users(self):
+        """Total number of valid accounts"""
+
+    @abstractmethod
+    def oldest_user(self):
+        """Name, e-mail address and creation time of the longest existing account, or None"""
+
+    @abstractmethod
+    def children_age_groups(self):
+        """
+        Number of children of every age, sorted by count (ascending); ages with the same count
+        keep the order they first appear in (by user id, then the order of the user's children)
+        """
+
+    @abstractmethod
+    def user_children(self, user_id):
+        """Children of the user, sorted by name"""
+
+    @abstractmethod
+    def similar_children_by_age(self, user_id):
+        """
+        Yield the other users having a child of the same age as any of the user's own children,
+        by id, along with all their children sorted by name
+        """
+
+    @abstractmethod
+    def users_with_children(self):
+        """
+        Yield (id, e-mail, firstname, telephone number, children) of every user by id, the
+        children as (name, age) pairs sorted by name, the way similar_children_by_age lists them
+        """
+
+    @abstractmethod
+    def iter_stored_users(self):
+        """
+        Yield (id, firstname, telephone number, e-mail, password hash, role, creation time,
+        children) of every user by id, as stored: the creation time in seconds since the epoch,
+        the children as Child records in the order they were written
+        """
+
+    @abstractmethod
+    def next_user_id(self):
+        """Id the next new user would get; the ids of removed users are never reused"""
+
+    @abstractmethod
+    def restore_users(self, users, next_id):
+        """
+        Fill the empty store with users given as iter_stored_users yields them, already
+        validated and with their passwords hashed, continuing the ids from next_id
+        """
+
+    def iter_ingested_files(self):
+        """
+        Yield (file name, sha256, size, resume offset) of the data files ingested so far, for
+        a snapshot to carry. None by default: the store ingests every file each time
+        """
+
+        return iter(())
+
+    def restore_ingested_files(self, files):
+        """
+        Remember the files, given as iter_ingested_files yields them, as ingested, so the next
+        incremental create_database skips them. Nothing by default
+        """
+
+    @classmethod
+    def validate_email(cls, email) -> bool:
+        """Check if the email meets the criteria in the tasks' Readme file"""
+
+        if email_regex.match(email):
+            return True
+        return False
+
+    @classmethod
+    def validate_phone_num(cls, phone_num) -> bool:
+        """
+        Check if the number after reformat can meet the criteria
+        i.e. no trailing zeros, 9-digits long
+        """
+
+        if len(cls.fix_phone_num(phone_num)) == 9:
+            return True
+        return False
+
+    @staticmethod
+    def fix_phone_num(phone_num):
+        """Phone number with trailing zeros, non-digit characters, etc. removed"""
+
+        return non_digit_regex.sub('', phone_num)[-9:]
+
+    @staticmethod
+    def validate_batch(emails, phone_nums):
+        """
+        Validate columns of e-mails and phone numbers in one pass, with the patterns compiled once.
+        Return the mask of valid rows, the fixed phone numbers and (row, reasons) of the rejected rows
+        """
+
+        match_email = email_regex.match
+        remove_non_digits = non_digit_regex.sub
+
+        valid_emails = [match_email(email) is not None for email in emails]
+        fixed_phone_nums = [remove_non_digits('', phone_num)[-9:] for phone_num in phone_nums]
+        valid_mask = [
+            valid_email and len(phone_num) == 9
+            for valid_email, phone_num in zip(valid_emails, fixed_phone_nums)
+        ]
+
+        rejected_rows = [
+            (
+                row,
+                ('invalid_email',) * (not valid_emails[row])
+                + ('invalid_telephone_number',) * (len(fixed_phone_nums[row]) != 9),
+            )
+            for row, is_valid in enumerate(valid_mask)
+            if not is_valid
+        ]
+
+        return valid_mask, fixed_phone_nums, rejected_rows
@@ -0,0 +1,165 @@
+import json
+import struct
+import sys
+
+FORMATS = ('text', 'json', 'ndjson', 'msgpack')
+
+
+class Result:
+    """
+    Outcome of an action: its status, the rows it produced (dicts, possibly
+    streamed by a generator) or a message instead of them. text_row turns
+    a row into its line of the text output
+    """
+
+    def __init__(self, rows=(), status='ok', message=None, text_row=str):
+        self.rows = rows
+        self.status = status
+        self.message = message
+        self.text_row = text_row
+
+    def header(self):
+        """Status record written before the rows, when there is anything to report"""
+
+        if self.status == 'ok' and self.message is None:
+            return None
+        return {'status': self.status, 'message': self.message}
+
+
+def write_result(result, out=None, output_format='text'):
+    """Write the result in the given format, streaming the rows one by one"""
+
+    out = out or sys.stdout
+
+    if output_format == 'text':
+        write_text(result, out)
+    elif output_format == 'json':
+        write_json(result, out)
+    elif output_format == 'ndjson':
+        write_ndjson(result, out)
+    elif output_format == 'msgpack':
+        write_msgpack(result, out)
+    else:
+        raise ValueError(f'Unknown output format: {output_format}')
+
+
+def write_text(result, out):
+    """Human-readable output, the way the CLI has always printed it"""
+
+    if result.message is not None:
+        print(f'\n{result.message}\n', file=out)
+        return
+
+    print(file=out)
+    for row in result.rows:
+        print(result.text_row(row), file=out)
+    print(file=out)
+
+
+def write_json(result, out):
+    """A single JSON document: {"status": ..., "message": ..., "rows": [...]}"""
+
+    out.write(
+        f'{{"status": {json.dumps(result.status)}, "message": {json.dumps(result.message)}, "rows": ['
+    )
+    for i, row in enumerate(result.rows):
+        if i:
+            out.write(', ')
+        out.write(json.dumps(row))
+    out.write(']}\n')
+
+
+def write_ndjson(result, out):
+    """One JSON object per line: the status record (if any), then every row"""
+
+    header = result.header()
+    if header is not None:
+        out.write(json.dumps(header) + '\n')
+
+    for row in result.rows:
+        out.write(json.dumps(row) + '\n')
+
+
+def write_msgpack(result, out):
+    """The same records as write_ndjson, as a stream of MessagePack objects"""
+
+    if hasattr(out, 'buffer'):  # Binary output goes below the text layer
+        out.flush()
+        out = out.buffer
+
+    header = result.header()
+    if header is not None:
+        out.write(pack(header))
+
+    for row in result.rows:
+        out.write(pack(row))
+    out.flush()
+
+
+def pack(value):
+    """Encode a JSON-like value in the MessagePack format, in its smallest encoding"""
+
+    if value is None:
+        return b'\xc0'
+    if value is True:
+        return b'\xc3'
+    if value is False:
+        return b'\xc2'
+    if isinstance(value, int):
+        if 0 <= value < 0x80:
+            return struct.pack('B', value)
+        if -0x20 <= value < 0:
+            return struct.pack('b', value)
+        for code, fmt in INT_FORMATS[value >= 0]:
+            try:
+                return code + struct.pack(fmt, value)
+            except struct.error:
+                continue
+        raise OverflowError(f'{value} does not fit in 64 bits')
+    if isinstance(value, float):
+        return b'\xcb' + struct.pack('>d', value)
+    if isinstance(value, str):
+        data = value.encode()
+        if len(data) < 32:
+            return struct.pack('B', 0xA0 | len(data)) + data
+        return pack_length(len(data), STR_FORMATS) + data
+    if isinstance(value, bytes):
+        return pack_length(len(value), BIN_FORMATS) + value
+    if isinstance(value, (list, tuple)):
+        return pack_array_header(len(value)) + b''.join(pack(item) for item in value)
+    if isinstance(value, dict):
+        if len(value) < 16:
+            header = struct.pack('B', 0x80 | len(value))
+        else:
+            header = pack_length(len(value), MAP_FORMATS)
+        return header + b''.join(pack(key) + pack(item) for key, item in value.items())
+
+    raise TypeError(f'Cannot pack {type(value).__name__}')
+
+
+def pack_array_header(length):
+    """Start of a MessagePack array of length items, to be followed by the packed items"""
+
+    if length < 16:
+        return struct.pack('B', 0x90 | length)
+    return pack_length(length, ARRAY_FORMATS)
+
+
+def pack_length(length, formats):
+    for code, fmt in formats:
+        try:
+            return code + struct.pack(fmt, length)
+        except struct.error:
+            continue
+    raise OverflowError(f'{length} items do not fit in 32 bits')
+
+
+# MessagePack type codes with their struct formats, narrowest first
+INT_FORMATS = {
+    True: ((b'\xcc', '>B'), (b'\xcd', '>H'), (b'\xce', '>I'), (b'\xcf', '>Q')),
+    False: ((b'\xd0', '>b'), (b'\xd1', '>h'), (b'\xd2', '>i'), (b'\xd3', '>q')),
+}
+STR_FORMATS = ((b'\xd9', '>B'), (b'\xda', '>H'), (b'\xdb', '>I'))
+BIN_FORMATS = ((b'\xc4', '>B'), (b'\xc5', '>H'), (b'\xc6', '>I'))
+ARRAY_FORMATS = ((b'\xdc', '>H'), (b'\xdd', '>I'))
+MAP_FORMATS = ((b'\xde', '>H'), (b'\xdf', '>I'))
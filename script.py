@@ -1,12 +1,16 @@
 import argparse
-import re
-import json
-import html
+from contextlib import nullcontext
+from functools import wraps
 
 from sqlite3 import OperationalError
-from collections import Counter
 
+from database import db_metrics
 from database.db_manager import DataHandler
+from output import FORMATS, Result, write_result
+from similar_children import NO_CHILDREN, format_similar_user, write_all_similar_children
+
+
+NO_DATABASE = "The database has not been created yet! Type 'python script.py create_database' to build it"
 
 
 def authenticate(func):
@@ -15,278 +19,188 @@ def authenticate(func):
     and whether the correct access data has been provided
     """
 
-    def wrapper(self, login, password):
+    @wraps(func)
+    def wrapper(self, login, password, *args, **kwargs):
         try:
-            if db_handler.validate_email(
-                login
-            ):  # The case in which an e-mail was provided as Login
-                db_handler.cursor.execute(
-                    """
-                    SELECT password
-                    FROM users
-                    WHERE email=?
-                    """,
-                    (login,),
-                )
-            elif db_handler.validate_phone_num(
-                login
-            ):  # The case in which a telephone number was provided as Login
-                login = re.sub(r'\D', '', login)[-9:]
-
-                db_handler.cursor.execute(
-                    """
-                    SELECT password
-                    FROM users
-                    WHERE telephone_number=?
-                    """,
-                    (login,),
-                )
-            result = db_handler.cursor.fetchone()[0]
+            session = self.db_handler.authenticate_user(login, password)
 
-            # Use html module to escape '&amp' chars from database password
-            if html.unescape(password) == html.unescape(result):
-                func(self, login, password)
-                
-            else:
-                print('\nInvalid Login\n')
-                
+        except OperationalError:
+            return self.output(Result(status='no_database', message=NO_DATABASE))
 
-        except TypeError:
-            print('\nInvalid Login\n')
+        if session is None:
+            return self.output(Result(status='invalid_login', message='Invalid Login'))
 
-        except OperationalError:
-            print(
-                "\nThe database has not been created yet! Type 'python script.py create_database' to build it\n"
-            )
+        self.session = session  # Logged in user, including their role
+        if login != session.email:  # Phone numbers are passed on the way they are stored
+            login = session.telephone_number
+
+        return func(self, login, password, *args, **kwargs)
 
     return wrapper
 
 
-def check_if_admin(login):
-    """Simple function to check if the given user has an admin role"""
+def check_if_admin(session):
+    """Simple function to check if the logged in user has an admin role"""
+
+    if session.role == 'admin':
+        return True
+    return False
+
+
+ADMIN_REQUIRED = 'Invalid Login - admin role required'
+
 
-    if '@' in login:
-        db_handler.cursor.execute(
-            """
-            SELECT role 
-            FROM users
-            WHERE email=?
-            """,
-            (login,),
+class Scripts:
+    def __init__(self, handler=None, out=None, output_format='text'):
+        # DataHandler and output stream of the actions, the module's db_handler and stdout by default
+        self.handler = handler
+        self.out = out
+        # One of output.FORMATS; with None the actions only return their results, rows unread
+        self.output_format = output_format
+        self.session = None  # Set by the authenticate decorator
+
+    @property
+    def db_handler(self):
+        return self.handler or db_handler
+
+    def output(self, result):
+        """Write the action's result in the chosen format and return it"""
+
+        if self.output_format is not None:
+            write_result(result, self.out, self.output_format)
+        return result
+
+    @db_metrics.timed_action
+    def create_database(
+        self, data_directory=None, manifest=None, workers=None, full=False, shadow=False
+    ):
+        self.db_handler.create_database(
+            data_directory=data_directory,
+            manifest=manifest,
+            workers=workers,
+            incremental=not full,
+            shadow=shadow,
         )
-    else:
-        db_handler.cursor.execute(
-            """
-            SELECT role 
-            FROM users
-            WHERE telephone_number=?
-            """,
-            (login,),
+        return self.output(
+            Result(message='Database has been successfully created and populated')
         )
 
-    result = db_handler.cursor.fetchone()[0]
+    @db_metrics.timed_action
+    def export_snapshot(self, path):
+        """Write the users to a snapshot file, for import_snapshot to restore elsewhere"""
 
-    if result == 'admin':
-        return True
-    return False
+        from database.db_snapshot import export_snapshot
 
+        try:
+            export_snapshot(self.db_handler, path)
+        except OperationalError:
+            return self.output(Result(status='no_database', message=NO_DATABASE))
 
-class Scripts:
-    def __init__(self):
-        pass
+        return self.output(Result(message=f'Snapshot has been written to {path}'))
+
+    @db_metrics.timed_action
+    def import_snapshot(self, path):
+        """Restore the users of a snapshot file into a new database, instead of create_database"""
 
-    def create_database(self):
-        db_handler.create_database()
-        print('\nDatabase has been successfully created and populated\n')
+        from database.db_snapshot import load_snapshot
+
+        try:
+            load_snapshot(path, self.db_handler)
+        except (OSError, ValueError) as error:
+            return self.output(Result(status='invalid_snapshot', message=str(error)))
+
+        return self.output(Result(message='Database has been successfully restored from the snapshot'))
 
     """ADMIN ONLY METHODS"""
 
+    @db_metrics.timed_action
     @authenticate
-    def print_all_accounts(self, login, password) -> int:
+    def print_all_accounts(self, login, password) -> Result:
         """Return the total number of valid accounts"""
 
-        if check_if_admin(login):
-            db_handler.cursor.execute(
-                """
-                SELECT COUNT(1) FROM users
-                """
+        if check_if_admin(self.session):
+            result = self.db_handler.count_users()
+            return self.output(
+                Result([{'accounts': result}], text_row=lambda row: row['accounts'])
             )
-            result = db_handler.cursor.fetchone()[0]
-            print(f'\n{int(result)}\n')
-        else:
-            print('\nInvalid Login - admin role required\n')
+        return self.output(Result(status='admin_required', message=ADMIN_REQUIRED))
 
+    @db_metrics.timed_action
     @authenticate
-    def print_oldest_account(self, login, password) -> str:
-        if check_if_admin(login):
-            db_handler.cursor.execute(
-                """
-                SELECT *
-                FROM users
-                ORDER BY created_at ASC
-                """
-            )
-            result = db_handler.cursor.fetchone()
-            print(
-                f'\nname: {result[1]}\nemail_address: {result[3]}\ncreated_at: {result[6]}\n'
+    def print_oldest_account(self, login, password) -> Result:
+        if check_if_admin(self.session):
+            result = self.db_handler.oldest_user()
+            return self.output(
+                Result(
+                    [result],
+                    text_row=lambda row: '\n'.join(f'{key}: {value}' for key, value in row.items()),
+                )
             )
+        return self.output(Result(status='admin_required', message=ADMIN_REQUIRED))
 
-        else:
-            print('\nInvalid Login - admin role required\n')
-
+    @db_metrics.timed_action
     @authenticate
-    def group_by_age(self, login, password) -> str:
+    def group_by_age(self, login, password) -> Result:
         """Group children by age, sort by count (ascending)"""
-        
-        if check_if_admin(login):
-            children_age = []
-
-            db_handler.cursor.execute(
-                """
-                SELECT children
-                FROM users
-                """
+
+        if check_if_admin(self.session):
+            return self.output(
+                Result(
+                    self.db_handler.children_age_groups(),
+                    text_row=lambda group: f"age: {group['age']}, count: {group['count']}",
+                )
             )
-            result = db_handler.cursor.fetchall()
-            
-            for row in result:
-                for age in re.findall(r'\d+', row[0]):
-                    children_age.append(int(age))
-            
-            c = Counter(children_age)
-            sorted_age = dict(sorted(c.items(), key=lambda x: x[1]))
-            # Sort age of the children by count- ascending
-
-            print()
-            for key, value in sorted_age.items():
-                print(f'age: {key}, count: {value}')
-            print()
-            
-        else:
-            print('\nInvalid Login - admin role required\n')
+        return self.output(Result(status='admin_required', message=ADMIN_REQUIRED))
+
+    @db_metrics.timed_action
+    @authenticate
+    def find_all_similar_children_by_age(self, login, password, workers=None) -> Result:
+        """
+        Run find_similar_children_by_age for every user at once, the users split between
+        the given number of processes. Written straight to the output, user by user
+        """
+
+        if check_if_admin(self.session):
+            if self.output_format is not None:
+                write_all_similar_children(self.db_handler, self.out, self.output_format, workers)
+            return Result()
+        return self.output(Result(status='admin_required', message=ADMIN_REQUIRED))
 
     """BOTH ADMIN AND USER METHODS"""
 
+    @db_metrics.timed_action
     @authenticate
-    def print_children(self, login, password) -> str:
+    def print_children(self, login, password) -> Result:
         """Return personal data of the logged-in user's children, sorted by name"""
 
-        if '@' in login:
-            db_handler.cursor.execute(
-                """
-                    SELECT children
-                    FROM users
-                    WHERE email=?   
-                """,
-                (login,),
-            )
-        else:
-            db_handler.cursor.execute(
-                """
-            SELECT children
-            FROM users
-            WHERE telephone_number=?
-            """,
-                (login,),
-            )
-
-        result = db_handler.cursor.fetchone()
-
-        if result[0] != '[]':
-            children_data = json.loads(result[0])  # Extract the children data
+        children = self.db_handler.user_children(self.session.user_id)
 
-            sorted_children = sorted(children_data, key=lambda x: x.get('name', ''))
-            print()
-            for child in sorted_children:
-                print(f"{child['name']}, {child['age']}")
-            print()
-        else:
-            print('\nThis user has no children\n')
+        if children:
+            return self.output(
+                Result(children, text_row=lambda child: f"{child['name']}, {child['age']}")
+            )
+        return self.output(Result(message=NO_CHILDREN))
 
+    @db_metrics.timed_action
     @authenticate
-    def find_similar_children_by_age(self, login, password) -> str:
+    def find_similar_children_by_age(self, login, password) -> Result:
         """Find users with children of the same age as at least user's one own child"""
 
-        user_children_age = []
-        common_users = []  # Avoid duplicating the output list of rows
-        common_phone_numbers = []  # --||--
-
-        if '@' in login:
-            db_handler.cursor.execute(
-                """
-                SELECT children, telephone_number
-                FROM users
-                WHERE email=?
-                """,
-                (login,),
-            )
-        else:
-            db_handler.cursor.execute(
-                """
-                SELECT children, telephone_number
-                FROM users
-                WHERE telephone_number=?
-                """,
-                (login,),
-            )
+        # The logged in user's details are excluded from the output message
+        if not self.db_handler.user_children(self.session.user_id):
+            return self.output(Result(message=NO_CHILDREN))
 
-        c = db_handler.cursor.fetchone()
-        result = json.loads(c[0])
-        
-        # Get the phone number of the logged in user to exclude their details from the output message
-        login = c[1]
-        if result == []: 
-            print('\nThis user has no children\n')
-            return
-        
-        for child in result:
-            user_children_age.append(str(child['age']))  # Get the age of user's each child
-
-        db_handler.cursor.execute(
-            """
-            SELECT firstname, telephone_number, children
-            FROM users
-            """
+        # Users are streamed from the database as they are written out
+        return self.output(
+            Result(
+                self.db_handler.similar_children_by_age(self.session.user_id),
+                text_row=format_similar_user,
+            )
         )
-        result = db_handler.cursor.fetchall()
-
-        # Extracting children data of subsequent users row by row
-        for user in result:
-            children_data = json.loads(user[2])
-            user_phone_number = user[1]
-
-            for child in children_data:
-                if str(child['age']) in user_children_age:   
-                    """Check whether any of the children of the checked user 
-                    are the same age as the child of the logged in user"""
-                    if user_phone_number not in common_phone_numbers and user_phone_number != login:
-                        common_users.append(
-                            {
-                                'firstname': user[0],
-                                'phone_number': user_phone_number,
-                                'children': children_data,
-                            }
-                        )
-                        common_phone_numbers.append(user_phone_number)
-        print()            
-        for user in common_users:
-            
-            children = sorted(
-                user['children'], key=lambda x: x.get('name', '')
-            )  # Sort children alphabetically by names
-            response = f"{user['firstname']}, {user['phone_number']}: "
-            
-            for child in children:
-                response += f"{child['name']}, {child['age']}; "
-            
-            print(response[:-2])
-        print()
-        
+
 
 if __name__ == '__main__':
-    db_handler = DataHandler('dbsqlite3')
     parser = argparse.ArgumentParser()
-    scripts = Scripts()
 
     parser.add_argument(
         'action',
@@ -297,27 +211,100 @@ if __name__ == '__main__':
             'group-by-age',
             'print-children',
             'find-similar-children-by-age',
+            'export-snapshot',
+            'import-snapshot',
         ],
     )
     parser.add_argument('--login', help='Login information', const=0, nargs='?')
     parser.add_argument('--password', help='Password information', const=0, nargs='?')
+    parser.add_argument(
+        '--data-dir', help='Directory with the data files to ingest (create_database)'
+    )
+    parser.add_argument(
+        '--manifest', help='File listing the data files to ingest (create_database)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of processes parsing the data files (create_database) '
+        'or matching the users (--all-users)',
+    )
+    parser.add_argument(
+        '--all-users',
+        action='store_true',
+        help='Run find-similar-children-by-age for every user at once (admin only)',
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Ingest all the data files again, even unchanged ones (create_database)',
+    )
+    parser.add_argument(
+        '--shadow',
+        action='store_true',
+        help='Ingest into a copy of the database, swapped in at the end, while it is being '
+        'queried (create_database)',
+    )
+    parser.add_argument(
+        '--snapshot', help='Snapshot file to write (export-snapshot) or restore (import-snapshot)'
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=FORMATS,
+        default='text',
+        help='Output format; json, ndjson and msgpack write structured records',
+    )
+
+    parser.add_argument(
+        '--metrics',
+        help='File to write stage timings, counters and action latencies to (.json, else Prometheus text)',
+    )
 
     args = parser.parse_args()
+    if args.action in ('export-snapshot', 'import-snapshot') and not args.snapshot:
+        parser.error(f'{args.action} requires --snapshot')
+
+    # Opened once the arguments are known to be valid, so --help and usage errors stay instant
+    db_handler = DataHandler('dbsqlite3')
+    scripts = Scripts(output_format=args.format)
+
+    if args.metrics:
+        db_metrics.enable()
+
+    # The actions only reading the database run on a single snapshot of it, even while
+    # another process is ingesting into it
+    reading = args.action not in ('create_database', 'import-snapshot')
+
+    with db_handler.read_snapshot() if reading else nullcontext():
+        if (args.action == 'create_database'):
+            scripts.create_database(
+                args.data_dir, args.manifest, args.workers, args.full, args.shadow
+            )
+
+        elif args.action == 'export-snapshot':
+            scripts.export_snapshot(args.snapshot)
+
+        elif args.action == 'import-snapshot':
+            scripts.import_snapshot(args.snapshot)
+
+        elif args.action == 'print-all-accounts':
+            scripts.print_all_accounts(args.login, args.password)
 
-    if (args.action == 'create_database'):
-        scripts.create_database()
+        elif args.action == 'print-oldest-account':
+            scripts.print_oldest_account(args.login, args.password)
 
-    elif args.action == 'print-all-accounts':
-        scripts.print_all_accounts(args.login, args.password)
+        elif args.action == 'group-by-age':
+            scripts.group_by_age(args.login, args.password)
 
-    elif args.action == 'print-oldest-account':
-        scripts.print_oldest_account(args.login, args.password)
+        elif args.action == 'print-children':
+            scripts.print_children(args.login, args.password)
 
-    elif args.action == 'group-by-age':
-        scripts.group_by_age(args.login, args.password)
+        elif args.action == 'find-similar-children-by-age' and args.all_users:
+            scripts.find_all_similar_children_by_age(args.login, args.password, args.workers)
 
-    elif args.action == 'print-children':
-        scripts.print_children(args.login, args.password)
+        elif args.action == 'find-similar-children-by-age':
+            scripts.find_similar_children_by_age(args.login, args.password)
 
-    elif args.action == 'find-similar-children-by-age':
-        scripts.find_similar_children_by_age(args.login, args.password)
+    if args.metrics:
+        db_metrics.export(args.metrics)
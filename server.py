@@ -0,0 +1,161 @@
+import argparse
+import io
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from database import db_metrics
+from database.db_pool import ConnectionPool, MemoryPool, POOL_SIZE
+from database.db_snapshot import load_snapshot
+from output import FORMATS
+from script import Scripts
+
+# Actions served on the pooled read connections, by their CLI names
+READ_ACTIONS = {
+    'print-all-accounts': 'print_all_accounts',
+    'print-oldest-account': 'print_oldest_account',
+    'group-by-age': 'group_by_age',
+    'print-children': 'print_children',
+    'find-similar-children-by-age': 'find_similar_children_by_age',
+}
+
+CONTENT_TYPES = {
+    'text': 'text/plain; charset=utf-8',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'msgpack': 'application/msgpack',
+}
+
+
+class ScriptsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Connections waiting to be accepted under bursts
+
+
+class ScriptsRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /<action> with a JSON body such as {"login": ..., "password": ...}.
+    The response holds the output the action prints in the CLI, in the
+    output format given by the optional "format" parameter
+    """
+
+    pool = None  # ConnectionPool shared by all the requests
+
+    def do_POST(self):
+        action = self.path.strip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+
+        try:
+            params = json.loads(self.rfile.read(length) or '{}')
+        except ValueError:
+            self.reply(400, 'Invalid JSON body\n')
+            return
+
+        output_format = params.get('format', 'text')
+        if output_format not in FORMATS:
+            self.reply(400, f'Unknown format: {output_format}\n')
+            return
+
+        out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+
+        if action == 'create_database':
+            with self.pool.writer() as handler:
+                Scripts(handler, out, output_format).create_database(
+                    params.get('data_dir'),
+                    params.get('manifest'),
+                    params.get('workers'),
+                    params.get('full', False),
+                    params.get('shadow', False),
+                )
+        elif action in READ_ACTIONS:
+            with self.pool.reader() as handler:
+                getattr(Scripts(handler, out, output_format), READ_ACTIONS[action])(
+                    params.get('login'), params.get('password')
+                )
+        else:
+            self.reply(404, f'Unknown action: {action}\n')
+            return
+
+        self.reply(200, out.buffer.getvalue(), CONTENT_TYPES[output_format])
+
+    def reply(self, status, body, content_type=CONTENT_TYPES['text']):
+        if isinstance(body, str):
+            body = body.encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep the hot path free of per-request logging
+
+
+def serve(
+    db_name='dbsqlite3',
+    host='127.0.0.1',
+    port=8000,
+    pool_size=POOL_SIZE,
+    metrics_file=None,
+    storage='sqlite',
+    snapshot=None,
+):
+    """
+    Serve the script.py actions until interrupted, paying process and connection setup once.
+    With the 'memory' storage the users are kept in RAM instead of the database file, filled
+    from the snapshot file, if given, or by a create_database request. With a metrics_file,
+    the collected metrics are written to it on shutdown
+    """
+
+    if metrics_file:
+        db_metrics.enable()
+
+    if storage == 'memory':
+        pool = MemoryPool()
+        if snapshot:
+            load_snapshot(snapshot, pool.storage)
+    else:
+        pool = ConnectionPool(db_name, pool_size)
+    handler_class = type('PooledRequestHandler', (ScriptsRequestHandler,), {'pool': pool})
+    server = ScriptsServer((host, port), handler_class)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+        if metrics_file:
+            db_metrics.export(metrics_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='dbsqlite3', help='Database file')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument(
+        '--pool-size', type=int, default=POOL_SIZE, help='Read connections kept open'
+    )
+
+    parser.add_argument(
+        '--metrics', help='File to write the metrics to on shutdown (.json, else Prometheus text)'
+    )
+    parser.add_argument(
+        '--storage',
+        choices=('sqlite', 'memory'),
+        default='sqlite',
+        help='Where the users are kept: the database file, or RAM (filled by create_database)',
+    )
+    parser.add_argument(
+        '--snapshot', help='Snapshot file to fill the memory storage from on startup'
+    )
+
+    args = parser.parse_args()
+    if args.snapshot and args.storage != 'memory':
+        parser.error('--snapshot requires --storage memory')
+
+    serve(
+        args.db, args.host, args.port, args.pool_size, args.metrics, args.storage, args.snapshot
+    )
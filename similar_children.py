@@ -0,0 +1,193 @@
+import json
+import sys
+from bisect import bisect_left
+from collections import defaultdict, deque
+from itertools import chain
+
+from output import pack, pack_array_header
+
+MATCHING_CHUNK_SIZE = 64  # Users matched per task of a worker process
+NO_CHILDREN = 'This user has no children'
+
+worker_index = None  # SimilarChildrenIndex of a worker process, set by init_worker
+
+
+def format_similar_user(user):
+    """Text line of a find_similar_children_by_age row"""
+
+    children = '; '.join(f"{child['name']}, {child['age']}" for child in user['children'])
+    return f"{user['firstname']}, {user['telephone_number']}: {children}"
+
+
+class SimilarChildrenIndex:
+    """
+    Everything needed to match every user with every other one, read from the database once:
+    the e-mail and own children ages of each user, the users having a child of each age and
+    each user's row of the find_similar_children_by_age output, encoded once in the output
+    format. A user's matches are then the encoded rows of the users sharing their ages
+    """
+
+    def __init__(self, storage, output_format='text'):
+        self.output_format = output_format
+        self.emails = []
+        self.own_ages = []  # Distinct ages of the user's children, None when there are none
+        self.encoded_rows = []
+        age_positions = defaultdict(list)  # Age -> positions of the users, ascending
+
+        for position, (_, email, firstname, telephone_number, children) in enumerate(
+            storage.users_with_children()
+        ):
+            ages = sorted({age for _, age in children if age is not None})
+            for age in ages:
+                age_positions[age].append(position)
+
+            self.emails.append(email)
+            self.own_ages.append(ages if children else None)
+            self.encoded_rows.append(
+                self.encode_row(
+                    {
+                        'firstname': firstname,
+                        'telephone_number': telephone_number,
+                        'children': [{'name': name, 'age': age} for name, age in children],
+                    }
+                )
+            )
+
+        self.age_positions = dict(age_positions)
+        self.age_rows = {
+            age: [self.encoded_rows[position] for position in positions]
+            for age, positions in self.age_positions.items()
+        }
+
+    def __len__(self):
+        return len(self.emails)
+
+    def encode_row(self, row):
+        if self.output_format == 'text':
+            return format_similar_user(row) + '\n'
+        if self.output_format == 'msgpack':
+            return pack(row)
+        return json.dumps(row)
+
+    def matches(self, position):
+        """Encoded rows of the other users with a child of the same age, ordered by id"""
+
+        ages = self.own_ages[position]
+
+        if len(ages) == 1:  # The rows of a single age are listed already
+            positions, rows = self.age_positions[ages[0]], self.age_rows[ages[0]]
+        else:
+            positions = list(
+                dict.fromkeys(sorted(chain.from_iterable(map(self.age_positions.get, ages))))
+            )
+            rows = list(map(self.encoded_rows.__getitem__, positions))
+
+        own_row = bisect_left(positions, position)  # Every user is among the users of their ages
+        return rows[:own_row] + rows[own_row + 1 :]
+
+    def encode_user(self, position):
+        """A user's e-mail along with what find_similar_children_by_age writes for them"""
+
+        email = self.emails[position]
+        message = NO_CHILDREN if self.own_ages[position] is None else None
+        rows = [] if message else self.matches(position)
+
+        if self.output_format == 'text':
+            return f'== {email}\n\n' + (f'{message}\n' if message else ''.join(rows)) + '\n'
+        if self.output_format == 'msgpack':
+            return (
+                b'\x84'  # Map of the 4 fields
+                + b''.join(
+                    pack(value) for value in ('email', email, 'status', 'ok', 'message', message)
+                )
+                + pack('rows')
+                + pack_array_header(len(rows))
+                + b''.join(rows)
+            )
+        return (
+            f'{{"email": {json.dumps(email)}, "status": "ok", "message": {json.dumps(message)}, '
+            f'"rows": [{", ".join(rows)}]}}'
+        )
+
+    def encode_users(self, start, stop):
+        """Output of the users at positions start to stop, as one string (bytes for msgpack)"""
+
+        users = map(self.encode_user, range(start, min(stop, len(self))))
+
+        if self.output_format == 'msgpack':
+            return b''.join(users)
+        if self.output_format == 'json':
+            return ', '.join(users)
+        if self.output_format == 'ndjson':
+            return ''.join(user + '\n' for user in users)
+        return ''.join(users)
+
+
+def init_worker(index):
+    global worker_index
+
+    worker_index = index
+
+
+def encode_users(start, stop):
+    return worker_index.encode_users(start, stop)
+
+
+def iter_encoded_chunks(storage, output_format='text', workers=None):
+    """
+    Yield the output of all the users, chunk by chunk, in the order of their ids. With several
+    workers the index is handed to every process of a pool once, and the chunks are encoded
+    there, a few chunks ahead of the consumer
+    """
+
+    index = SimilarChildrenIndex(storage, output_format)
+
+    if not workers or workers <= 1:
+        for start in range(0, len(index), MATCHING_CHUNK_SIZE):
+            yield index.encode_users(start, start + MATCHING_CHUNK_SIZE)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor  # Only the parallel runs pay for it
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(index,)
+    ) as executor:
+        pending = deque()
+
+        for start in range(0, len(index), MATCHING_CHUNK_SIZE):
+            pending.append(executor.submit(encode_users, start, start + MATCHING_CHUNK_SIZE))
+            if len(pending) > 2 * workers:  # Limit the encoded chunks waiting in memory
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_all_similar_children(storage, out=None, output_format='text', workers=None):
+    """
+    Write the find_similar_children_by_age output of every user, computed in a single pass
+    instead of one query per user: in the text format, an '== <e-mail>' line followed by what
+    the command prints for the user; otherwise one record per user with its e-mail and the
+    fields of the command's structured output
+    """
+
+    out = out or sys.stdout
+    if output_format == 'msgpack' and hasattr(out, 'buffer'):  # Binary goes below the text layer
+        out.flush()
+        out = out.buffer
+
+    if output_format == 'json':
+        out.write('{"status": "ok", "message": null, "rows": [')
+
+    written = False
+    for chunk in iter_encoded_chunks(storage, output_format, workers):
+        if not chunk:
+            continue
+        if output_format == 'json' and written:
+            out.write(', ')
+        out.write(chunk)
+        written = True
+
+    if output_format == 'json':
+        out.write(']}\n')
+    out.flush()
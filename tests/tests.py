@@ -1,12 +1,49 @@
+import asyncio
+import hashlib
+import hmac
+import io
+import json
 import pytest
+import shutil
 import sqlite3
+import subprocess
+import sys
+import threading
+import urllib.request
+import zlib
+from collections import Counter
+from contextlib import closing
+from datetime import datetime, timedelta
 from pathlib import Path
 
-from database import db_manager, db_parser
+import async_scripts
+from benchmarks import generate_data
+import output
+import script
+import server
+from database import (
+    db_auth,
+    db_manager,
+    db_memory,
+    db_metrics,
+    db_parser,
+    db_pipeline,
+    db_pool,
+    db_records,
+    db_snapshot,
+    db_time,
+)
 
 
 TEST_DATA = db_parser.DataParser.parse_json("users.json")
 
+# Passwords are stored with random salts, so they differ between otherwise identical tables
+USERS_WITHOUT_PASSWORDS = """
+    SELECT id, firstname, telephone_number, email, role, created_at, children
+    FROM users
+    ORDER BY id
+"""
+
 @pytest.fixture
 def temporary_db():
     """Create a temporary database for testing purposes"""
@@ -162,3 +199,1150 @@ class TestDataValidator:
         )
 
         clear_test_database(cursor)
+
+    def test_batch_validation(self, tmp_path):
+        """Check if validating whole columns agrees with the per-value checks and reports why rows are rejected"""
+
+        valid_mask, fixed_phone_nums, rejected_rows = db_manager.DataHandler.validate_batch(
+            [user["email"] for user in TEST_DATA],
+            [user["telephone_number"] for user in TEST_DATA],
+        )
+
+        for user, is_valid, fixed_phone_num in zip(TEST_DATA, valid_mask, fixed_phone_nums):
+            valid_email = db_manager.DataHandler.validate_email(user["email"])
+            valid_phone_num = db_manager.DataHandler.validate_phone_num(user["telephone_number"])
+            assert is_valid == (valid_email and valid_phone_num)
+            if is_valid:
+                assert fixed_phone_num == db_manager.DataHandler.fix_phone_num(user["telephone_number"])
+
+        assert [row for row, _ in rejected_rows] == [
+            row for row, is_valid in enumerate(valid_mask) if not is_valid
+        ]
+
+        rejected = []
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database()
+        db_handler.add_data(
+            [dict(TEST_DATA[0], email="no-at-sign", telephone_number="12-34")],
+            format="json",
+            rejected=rejected,
+        )
+        assert [reasons for _, reasons in rejected] == [
+            ("invalid_email", "invalid_telephone_number")
+        ]
+
+
+class TestTimes:
+
+    def test_parse_time_matches_strptime(self):
+        """Check if the fast parser reads times the way strptime does, and rejects what strptime rejects"""
+
+        for user in TEST_DATA:
+            parsed = datetime.strptime(user["created_at"], db_time.TIME_FORMAT)
+            seconds = db_time.parse_time(user["created_at"])
+
+            assert seconds == (parsed - datetime(1970, 1, 1)) // timedelta(seconds=1)
+            assert db_time.format_time(seconds) == user["created_at"]
+
+        for text in ("2023-01-01T00:00:00", "2023-02-30 00:00:00", "2023-01-01 00:00", "2023-W01-1 00:00:00"):
+            with pytest.raises(ValueError):
+                db_time.parse_time(text)
+
+    def test_parse_time_accepts_unpadded_fields(self):
+        """Check if times without zero padding, which strptime accepts, are read the same way"""
+
+        for text in ("2023-1-1 0:0:0", "2023-01-1 9:05:7", "2023-12-31 23:59:59", "2023-01-01 1:2:3"):
+            parsed = datetime.strptime(text, db_time.TIME_FORMAT)
+            assert db_time.parse_time(text) == (parsed - datetime(1970, 1, 1)) // timedelta(seconds=1)
+
+        for text in ("2023-1-1 0:0", "2023-13-1 0:0:0", "2023-1-1 24:0:0"):
+            with pytest.raises(ValueError):
+                datetime.strptime(text, db_time.TIME_FORMAT)
+            with pytest.raises(ValueError):
+                db_time.parse_time(text)
+
+
+class TestBatchedIngest:
+
+    def test_batch_size_does_not_change_result(self, tmp_path):
+        """Check if writing many rows per transaction gives the same table as writing them one by one"""
+
+        tables = []
+
+        for batch_size in (1, db_manager.BATCH_SIZE):
+            db_handler = db_manager.DataHandler(str(tmp_path / f"db_{batch_size}"))
+            db_handler.create_database(batch_size=batch_size)
+            db_handler.cursor.execute(USERS_WITHOUT_PASSWORDS)
+            tables.append(db_handler.cursor.fetchall())
+
+        assert tables[0] == tables[1]
+        assert len(tables[0]) == 84
+
+    def test_user_stats_follow_the_writes(self, tmp_path):
+        """Check if the stored account count and oldest account match the table after updates and inserts"""
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+
+        def stats_match_table():
+            db_handler.cursor.execute("SELECT COUNT(1) FROM users")
+            count = db_handler.cursor.fetchone()[0]
+            db_handler.cursor.execute(
+                "SELECT firstname, email, created_at FROM users ORDER BY created_at LIMIT 1"
+            )
+            firstname, email, created_at = db_handler.cursor.fetchone()
+            return db_handler.count_users() == count and tuple(
+                db_handler.oldest_user().values()
+            ) == (firstname, email, db_time.format_time(created_at))
+
+        db_handler.create_database()
+        assert stats_match_table()
+
+        oldest = dict(
+            next(user for user in TEST_DATA if user["email"] == db_handler.oldest_user()["email_address"])
+        )
+        newer_oldest = dict(oldest, created_at="2099-01-01 00:00:00")
+        new_user = dict(
+            oldest,
+            email="new.user@example.com",
+            telephone_number="111222333",
+            created_at="2000-01-01 00:00:00",
+        )
+        db_handler.add_data([newer_oldest, new_user], format="json")
+
+        assert stats_match_table()
+        assert db_handler.count_users() == 85
+        assert db_handler.oldest_user()["email_address"] == "new.user@example.com"
+
+
+class TestSchemaUpgrade:
+
+    def test_existing_database_is_migrated(self, tmp_path):
+        """Check if a database built without indexes gets them, dropping the repeated rows"""
+
+        db_path = str(tmp_path / "old_db")
+        connection = sqlite3.connect(db_path)
+        connection.execute(
+            """
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                firstname TEXT,
+                telephone_number TEXT,
+                email TEXT,
+                password TEXT,
+                role TEXT,
+                created_at DATETIME,
+                children TEXT
+            )
+            """
+        )
+        connection.executemany(
+            """
+            INSERT INTO users (firstname, telephone_number, email, password, role, created_at, children)
+            VALUES (?, ?, ?, 'pass', 'user', '2023-01-01 00:00:00', '[]')
+            """,
+            [
+                ("First", "123456789", "first@example.com"),
+                ("Second", "123456789", "second@example.com"),
+                ("Third", "987654321", "first@example.com"),
+            ],
+        )
+        connection.commit()
+        connection.close()
+
+        db_handler = db_manager.DataHandler(db_path)
+
+        db_handler.cursor.execute("SELECT firstname FROM users")
+        assert db_handler.cursor.fetchall() == [("First",)]
+
+        db_handler.cursor.execute(
+            "EXPLAIN QUERY PLAN SELECT password FROM users WHERE telephone_number=?",
+            ("123456789",),
+        )
+        assert "users_telephone_number" in db_handler.cursor.fetchone()[-1]
+
+        assert db_handler.count_users() == 1
+        assert db_handler.oldest_user()["name"] == "First"
+
+        db_handler.cursor.execute("SELECT created_at FROM users")
+        assert db_handler.cursor.fetchone()[0] == db_time.parse_time("2023-01-01 00:00:00")
+
+    @pytest.mark.parametrize(
+        "created_at, epoch", [("2023-1-1 0:0:0", 1672531200), ("yesterday", None)]
+    )
+    def test_created_at_is_migrated_like_the_ingest_reads_it(self, tmp_path, created_at, epoch):
+        """Check if legacy text times are converted by parse_time, and unreadable ones are refused"""
+
+        db_path = str(tmp_path / "old_db")
+        connection = sqlite3.connect(db_path)
+        connection.execute(
+            """
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                firstname TEXT,
+                telephone_number TEXT,
+                email TEXT,
+                password TEXT,
+                role TEXT,
+                created_at DATETIME,
+                children TEXT
+            )
+            """
+        )
+        connection.execute(
+            """
+            INSERT INTO users (firstname, telephone_number, email, password, role, created_at, children)
+            VALUES ('First', '123456789', 'first@example.com', 'pass', 'user', ?, '[]')
+            """,
+            (created_at,),
+        )
+        connection.commit()
+        connection.close()
+
+        if epoch is None:
+            with pytest.raises(ValueError, match="yesterday"):
+                db_manager.DataHandler(db_path)
+            return
+
+        db_handler = db_manager.DataHandler(db_path)
+        assert db_handler.cursor.execute("SELECT created_at FROM users").fetchone() == (epoch,)
+        assert db_handler.oldest_user()["created_at"] == "2023-01-01 00:00:00"
+
+    def test_plaintext_passwords_are_hashed_by_create_database(self, tmp_path):
+        """Check if opening an old database leaves its passwords alone until create_database"""
+
+        db_path = str(tmp_path / "old_db")
+        connection = sqlite3.connect(db_path)
+        connection.execute(
+            """
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                firstname TEXT,
+                telephone_number TEXT,
+                email TEXT,
+                password TEXT,
+                role TEXT,
+                created_at DATETIME,
+                children TEXT
+            )
+            """
+        )
+        connection.execute(
+            """
+            INSERT INTO users (firstname, telephone_number, email, password, role, created_at, children)
+            VALUES ('First', '123456789', 'first@example.com', 'p&amp;ss', 'user', '2023-01-01 00:00:00', '[]')
+            """
+        )
+        connection.commit()
+        connection.close()
+
+        db_handler = db_manager.DataHandler(db_path)
+        assert db_handler.cursor.execute("SELECT password FROM users").fetchone() == ("p&amp;ss",)
+        assert db_handler.authenticate_user("first@example.com", "p&ss") is not None
+        assert db_handler.authenticate_user("first@example.com", "wrong") is None
+
+        (tmp_path / "no_data").mkdir()
+        db_handler.create_database(data_directory=tmp_path / "no_data")
+        (password_hash,) = db_handler.cursor.execute("SELECT password FROM users").fetchone()
+        assert db_auth.is_password_hash(password_hash)
+        assert db_auth.verify_password("p&ss", password_hash)
+
+
+class TestXmlStreaming:
+
+    def test_iter_xml_yields_normalized_users(self):
+        """Check if streaming the .xml file gives the same users as parsing it whole"""
+
+        streamed_users = db_parser.DataParser.iter_xml("users_1.xml")
+
+        assert not isinstance(streamed_users, list)
+        assert list(streamed_users) == db_parser.DataParser.parse_xml("users_")[0]
+
+
+class TestCsvFastPath:
+
+    @staticmethod
+    def as_rows(filename):
+        return list(db_parser.DataParser.iter_csv_as_rows(filename))
+
+    def test_bundled_files_match_csv_module(self, monkeypatch):
+        """Check if the fast .csv reader gives the rows of the csv module, however the blocks are cut"""
+
+        for block_size in (64, db_parser.CSV_BLOCK_SIZE):
+            monkeypatch.setattr(db_parser, "CSV_BLOCK_SIZE", block_size)
+            for filename in ("users_1.csv", "users_2.csv"):
+                assert list(db_parser.DataParser.iter_csv_rows(filename)) == self.as_rows(filename)
+
+    def test_unusual_files_match_csv_module(self, tmp_path, monkeypatch):
+        """Check if quoted values, odd children fields and blank lines are read as by the csv module"""
+
+        monkeypatch.setattr(db_parser, "CSV_BLOCK_SIZE", 64)
+        header = ";".join(db_parser.CSV_FIELDS)
+        lines = [
+            "Anna;123456789;anna@example.com;pass;admin;2022-01-01 00:00:00;Mindy (11), Joan (3)",
+            "Joan;123456788;joan@example.com;pass;user;2022-01-01 00:00:00;",
+            "Mark;123456787;mark@example.com;pass;user;2022-01-01 00:00:00;Justin(4),,x",
+            "",
+            'Erin;123456785;"erin;@example.com";pass;user;2022-01-01 00:00:00;"Anna (2)"',
+        ]
+
+        for end in (2, 3, len(lines)):  # Without and with the fallbacks, from a later block on
+            data_file = tmp_path / f"users_{end}.csv"
+            data_file.write_text("\n".join([header, *lines[:end]]) + "\n")
+
+            assert list(db_parser.DataParser.iter_csv_rows(data_file)) == self.as_rows(data_file)
+
+    def test_blank_line_in_a_block_without_a_trailing_newline(self, tmp_path, monkeypatch):
+        """Check if a blank line in the last block, which has no trailing newline, shifts no values"""
+
+        lines = (db_parser.manager_directory / "data" / "users_1.csv").read_text().rstrip("\n").split("\n")
+        data_file = tmp_path / "users_1.csv"
+        data_file.write_text("\n".join([*lines[:5], "", *lines[5:]]))
+
+        for block_size in (64, db_parser.CSV_BLOCK_SIZE):
+            monkeypatch.setattr(db_parser, "CSV_BLOCK_SIZE", block_size)
+            assert list(db_parser.DataParser.iter_csv_rows(data_file)) == self.as_rows(data_file)
+
+
+class TestRecords:
+
+    def test_parsers_yield_records_with_int_ages(self):
+        """Check if every format gives User records with int ages, passed on by the normalization as they are"""
+
+        for path, source_format in db_parser.DataParser.discover_sources():
+            parsed = list(db_parser.DataParser.iter_source(path, source_format))
+            users = list(db_parser.DataParser.convert_to_common_format(parsed, source_format))
+
+            assert all(type(user) is db_records.User for user in users)
+            assert all(type(child.age) is int for user in users for child in user.children)
+            if source_format != "json":
+                assert all(user is record for user, record in zip(users, parsed))
+
+        assert db_records.user_from_dict(
+            dict(TEST_DATA[0], children=[{"name": "Anna", "age": " 3"}, {"name": "Joan", "age": "x"}])
+        ).children == [("Anna", 3), ("Joan", None)]
+
+
+class TestStreamingPipeline:
+
+    def test_iter_json_across_chunk_boundaries(self):
+        """Check if the .json file is streamed correctly no matter where the chunks are cut"""
+
+        for chunk_size in (1, 7, db_parser.JSON_CHUNK_SIZE):
+            assert list(db_parser.DataParser.iter_json("users.json", chunk_size)) == TEST_DATA
+
+    def test_prefetch_keeps_order_and_reraises(self):
+        """Check if prefetched items keep their order and errors of the producer reach the consumer"""
+
+        def failing_source():
+            yield from range(1000)
+            raise ValueError("broken file")
+
+        consumed = []
+
+        with pytest.raises(ValueError):
+            for item in db_pipeline.prefetch(failing_source(), max_items=10):
+                consumed.append(item)
+
+        assert consumed == list(range(1000))
+
+
+class TestSourceDiscovery:
+
+    def test_bundled_files_are_discovered_in_order(self):
+        """Check if the data files are found and ordered the way they used to be ingested"""
+
+        sources = db_parser.DataParser.discover_sources()
+
+        assert [(path.name, source_format) for path, source_format in sources] == [
+            ("users.json", "json"),
+            ("users_1.csv", "csv"),
+            ("users_2.csv", "csv"),
+            ("users_1.xml", "xml"),
+            ("users_2.xml", "xml"),
+        ]
+
+    def test_manifest_keeps_listed_order(self, tmp_path):
+        """Check if the files listed in a manifest are ingested in the listed order"""
+
+        data_directory = db_parser.manager_directory / "data"
+        manifest = tmp_path / "manifest.txt"
+        manifest.write_text(
+            f"# Partner shards\n{data_directory / 'users_2.xml'}\n\n{data_directory / 'users.json'}\n"
+        )
+
+        sources = db_parser.DataParser.discover_sources(manifest=manifest)
+
+        assert [path.name for path, _ in sources] == ["users_2.xml", "users.json"]
+
+    def test_relative_paths_are_read_from_the_working_directory(self, tmp_path, monkeypatch):
+        """Check if a relative data directory and manifest are found from another working directory"""
+
+        shutil.copytree(db_parser.manager_directory / "data", tmp_path / "shards")
+        (tmp_path / "lists").mkdir()
+        (tmp_path / "lists" / "manifest.txt").write_text("../shards/users_2.xml\n../shards/users.json\n")
+        monkeypatch.chdir(tmp_path)
+        shards = (tmp_path / "shards").resolve()
+
+        sources = db_parser.DataParser.discover_sources(data_directory="shards")
+        assert all(path.is_absolute() and path.parent == shards for path, _ in sources)
+
+        manifest_sources = db_parser.DataParser.discover_sources(manifest="lists/manifest.txt")
+        assert manifest_sources == [(shards / "users_2.xml", "xml"), (shards / "users.json", "json")]
+
+        db_handler = db_manager.DataHandler("db")
+        db_handler.create_database(data_directory="shards")
+        assert db_handler.count_users() == 84
+
+        # Bare names given to the readers are still those of the bundled data files
+        assert db_parser.DataParser.parse_json("users.json") == TEST_DATA
+
+        db_handler.connection.close()
+
+    def test_parallel_parsing_gives_the_same_table(self, tmp_path):
+        """Check if parsing the files in a process pool does not change the result"""
+
+        tables = []
+
+        for workers in (None, 3):
+            db_handler = db_manager.DataHandler(str(tmp_path / f"db_{workers}"))
+            db_handler.create_database(workers=workers)
+            db_handler.cursor.execute(USERS_WITHOUT_PASSWORDS)
+            tables.append(db_handler.cursor.fetchall())
+
+        assert tables[0] == tables[1]
+
+
+class TestIncrementalIngest:
+
+    def test_only_new_rows_are_ingested(self, tmp_path):
+        """Check if a re-run skips unchanged files and reads only the rows appended to a .csv file"""
+
+        data_directory = tmp_path / "data"
+        shutil.copytree(db_parser.manager_directory / "data", data_directory)
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database(data_directory=data_directory)
+
+        sources = db_parser.DataParser.discover_sources(data_directory)
+        assert db_handler.find_pending_sources(sources) == []
+
+        csv_path = data_directory / "users_2.csv"
+        old_size = csv_path.stat().st_size
+        with open(csv_path, "a") as csv_file:
+            csv_file.write("\nNew;123456789;new.user@example.com;Pass1;user;2023-12-01 10:00:00;Ala (3)\n")
+
+        pending_sources = db_handler.find_pending_sources(sources)
+        assert [(path.name, offset > 0) for path, _, offset, _ in pending_sources] == [
+            ("users_2.csv", True)
+        ]
+        assert pending_sources[0][2] < old_size  # The unterminated last row is read again
+
+        db_handler.create_database(data_directory=data_directory)
+
+        db_handler.cursor.execute("SELECT COUNT(1) FROM users")
+        assert db_handler.cursor.fetchone()[0] == 85
+        assert db_handler.find_pending_sources(sources) == []
+
+
+class TestChildrenTable:
+
+    def test_children_table_matches_users(self, tmp_path):
+        """Check if the children table holds the same children, in the same order, as users.children"""
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database()
+
+        db_handler.cursor.execute("SELECT id, children FROM users")
+        expected = [
+            (user_id, child["name"], int(child["age"]))
+            for user_id, children in db_handler.cursor.fetchall()
+            for child in json.loads(children)
+        ]
+
+        db_handler.cursor.execute("SELECT user_id, name, age FROM children ORDER BY user_id, id")
+        assert db_handler.cursor.fetchall() == sorted(expected, key=lambda child: child[0])
+
+
+@pytest.fixture
+def scripts_db(tmp_path, monkeypatch):
+    """Database built from the bundled data files, used by the script.py actions"""
+
+    db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+    db_handler.create_database()
+    monkeypatch.setattr(script, "db_handler", db_handler, raising=False)
+
+    yield db_handler
+
+    db_handler.connection.close()
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def storage(request, tmp_path, monkeypatch):
+    """The bundled data files in each storage engine, used by the script.py actions"""
+
+    if request.param == "sqlite":
+        storage = db_manager.DataHandler(str(tmp_path / "db"))
+    else:
+        storage = db_memory.MemoryStorage()
+    storage.create_database()
+    monkeypatch.setattr(script, "db_handler", storage, raising=False)
+
+    yield storage
+
+    if request.param == "sqlite":
+        storage.connection.close()
+
+
+class TestScripts:
+
+    def test_similar_children_by_age(self, storage, capsys):
+        """Check if the users sharing a child's age are found, the way scanning every user would"""
+
+        login, password = "lowerykimberly@example.net", "6mKY!nP^+y"
+
+        users = list(storage.users_with_children())
+        own_ages = {age for _, email, _, _, children in users if email == login for _, age in children}
+        expected = [
+            f"{firstname}, {phone}: " + "; ".join(f"{name}, {age}" for name, age in children)
+            for _, email, firstname, phone, children in users
+            if email != login and own_ages & {age for _, age in children}
+        ]
+
+        script.Scripts().find_similar_children_by_age(login, password)
+
+        assert capsys.readouterr().out.strip().splitlines() == expected
+
+    def test_all_similar_children_by_age(self, storage):
+        """Check if matching all the users at once gives every user's find_similar_children_by_age output"""
+
+        login, password = "opoole@example.org", "+3t)mSM6xX"
+
+        expected = [
+            {
+                "email": email,
+                "status": "ok",
+                "message": None if children else "This user has no children",
+                "rows": list(storage.similar_children_by_age(user_id)) if children else [],
+            }
+            for user_id, email, _, _, children in storage.users_with_children()
+        ]
+
+        outputs = {}
+        for output_format, workers in (("ndjson", None), ("ndjson", 2), ("json", None), ("text", 2)):
+            out = io.StringIO()
+            script.Scripts(out=out, output_format=output_format).find_all_similar_children_by_age(
+                login, password, workers
+            )
+            outputs[output_format, workers] = out.getvalue()
+
+        assert [json.loads(line) for line in outputs["ndjson", None].splitlines()] == expected
+        assert outputs["ndjson", 2] == outputs["ndjson", None]
+        assert json.loads(outputs["json", None])["rows"] == expected
+        assert outputs["text", 2] == "".join(
+            f"== {user['email']}\n\n"
+            + (
+                f"{user['message']}\n"
+                if user["message"]
+                else "".join(script.format_similar_user(row) + "\n" for row in user["rows"])
+            )
+            + "\n"
+            for user in expected
+        )
+
+        result = script.Scripts(output_format=None).find_all_similar_children_by_age(
+            "jason92@example.org", "Z#7VMvf%d^"
+        )
+        assert result.status == "admin_required"
+
+    def test_group_by_age(self, scripts_db, capsys):
+        """Check if children are counted by age, ascending by count, ties in order of first appearance"""
+
+        scripts_db.cursor.execute("SELECT children FROM users ORDER BY id")
+        ages = Counter(
+            int(child["age"])
+            for (children,) in scripts_db.cursor.fetchall()
+            for child in json.loads(children)
+        )
+        expected = [
+            f"age: {age}, count: {count}"
+            for age, count in sorted(ages.items(), key=lambda item: item[1])
+        ]
+
+        script.Scripts().group_by_age("opoole@example.org", "+3t)mSM6xX")
+
+        assert capsys.readouterr().out.strip().splitlines() == expected
+
+    def test_structured_output(self, storage):
+        """Check if json and ndjson write the same rows the action returns, and errors as status records"""
+
+        login, password = "opoole@example.org", "+3t)mSM6xX"
+        rows = list(script.Scripts(output_format=None).group_by_age(login, password).rows)
+
+        out = io.StringIO()
+        script.Scripts(out=out, output_format="ndjson").group_by_age(login, password)
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == rows
+
+        out = io.StringIO()
+        script.Scripts(out=out, output_format="json").group_by_age(login, password)
+        assert json.loads(out.getvalue()) == {"status": "ok", "message": None, "rows": rows}
+
+        out = io.StringIO()
+        script.Scripts(out=out, output_format="ndjson").group_by_age(login, "wrong")
+        assert json.loads(out.getvalue()) == {"status": "invalid_login", "message": "Invalid Login"}
+
+    def test_msgpack_output(self):
+        """Check if the records are encoded as MessagePack, one object per row"""
+
+        assert output.pack({"age": 5, "count": 300}) == (
+            b"\x82\xa3age\x05\xa5count\xcd\x01\x2c"
+        )
+        assert output.pack([None, True, -1, -128, "x" * 40]) == (
+            b"\x95\xc0\xc3\xff\xd0\x80\xd9\x28" + b"x" * 40
+        )
+
+        out = io.BytesIO()
+        output.write_result(output.Result([{"a": 1}, {"a": 2}]), out, "msgpack")
+        assert out.getvalue() == b"\x81\xa1a\x01\x81\xa1a\x02"
+
+
+class TestQueryService:
+
+    def test_pool_reuses_read_only_connections(self, tmp_path):
+        """Check if the pool hands out the same read-only connections again, with the database in WAL mode"""
+
+        pool = db_pool.ConnectionPool(str(tmp_path / "db"), size=1)
+        with pool.writer() as db_handler:
+            db_handler.create_database()
+
+            db_handler.cursor.execute("PRAGMA journal_mode")
+            assert db_handler.cursor.fetchone()[0] == "wal"
+
+        with pool.reader() as first_handler:
+            with pytest.raises(sqlite3.OperationalError):
+                first_handler.cursor.execute("DELETE FROM users")
+
+        with pool.reader() as second_handler:
+            assert second_handler is first_handler
+
+        pool.close()
+
+    def test_shadow_ingest_is_swapped_in_at_once(self, tmp_path, monkeypatch):
+        """Check if readers keep their snapshot during a shadow ingest, which then applies as a whole"""
+
+        monkeypatch.setattr(db_auth, "HASH_ITERATIONS", 1)
+        data_directory = tmp_path / "data"
+        data_directory.mkdir()
+        shutil.copy(db_parser.manager_directory / "data" / "users.json", data_directory)
+
+        pool = db_pool.ConnectionPool(str(tmp_path / "db"))
+        plain_handler = db_manager.DataHandler(str(tmp_path / "plain"))
+        with pool.writer() as db_handler:
+            db_handler.create_database(data_directory=data_directory)
+        plain_handler.create_database(data_directory=data_directory)
+
+        shutil.copytree(db_parser.manager_directory / "data", data_directory, dirs_exist_ok=True)
+        with pool.reader() as reader:
+            users_before = reader.cursor.execute(USERS_WITHOUT_PASSWORDS).fetchall()
+            emails = {row[3] for row in users_before}
+            user = next(user for user in TEST_DATA if user["email"] in emails)
+            assert reader.authenticate_user(user["email"], user["password"]) is not None
+
+            # Readers starting after every ingested file still get the users from before
+            users_during = []
+            record_ingested_file = db_manager.DataHandler.record_ingested_file
+
+            def record_and_read(db_handler, *args):
+                record_ingested_file(db_handler, *args)
+                with pool.reader() as other_reader:
+                    other_reader.cursor.execute(USERS_WITHOUT_PASSWORDS)
+                    users_during.append(other_reader.cursor.fetchall())
+
+            with pool.writer() as db_handler, monkeypatch.context() as patched:
+                patched.setattr(db_manager.DataHandler, "record_ingested_file", record_and_read)
+                db_handler.create_database(data_directory=data_directory, shadow=True)
+
+            assert len(users_during) >= 4  # One per data file
+            assert all(users == users_before for users in users_during)
+
+            # The snapshot taken before the swap is still the one being read
+            assert reader.cursor.execute(USERS_WITHOUT_PASSWORDS).fetchall() == users_before
+            assert reader.count_users() == len(users_before)
+
+        plain_handler.create_database(data_directory=data_directory)
+        with pool.reader() as reader:
+            users_after = reader.cursor.execute(USERS_WITHOUT_PASSWORDS).fetchall()
+            assert users_after == plain_handler.cursor.execute(USERS_WITHOUT_PASSWORDS).fetchall()
+            assert users_after != users_before
+            assert reader.count_users() == len(users_after)
+
+        assert pool.sessions.get(user["email"], user["password"]) is None
+        assert sorted(path.name for path in tmp_path.glob("db*")) == ["db", "db-shm", "db-wal"]
+
+        pool.close()
+        plain_handler.connection.close()
+
+    def test_shadow_ingest_is_dropped_after_another_write(self, tmp_path, monkeypatch):
+        """Check if a commit made by another connection during a shadow ingest is not overwritten"""
+
+        monkeypatch.setattr(db_auth, "HASH_ITERATIONS", 1)
+        data_directory = tmp_path / "data"
+        data_directory.mkdir()
+        shutil.copy(db_parser.manager_directory / "data" / "users.json", data_directory)
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database(data_directory=data_directory)
+        shutil.copytree(db_parser.manager_directory / "data", data_directory, dirs_exist_ok=True)
+
+        record_ingested_file = db_manager.DataHandler.record_ingested_file
+
+        def record_and_write(shadow_handler, *args):
+            record_ingested_file(shadow_handler, *args)
+            with closing(sqlite3.connect(tmp_path / "db")) as other_connection, other_connection:
+                other_connection.execute("UPDATE users SET firstname = 'Changed' WHERE id = 1")
+
+        monkeypatch.setattr(db_manager.DataHandler, "record_ingested_file", record_and_write)
+        with pytest.raises(RuntimeError):
+            db_handler.create_database(data_directory=data_directory, shadow=True)
+
+        assert db_handler.cursor.execute("SELECT firstname FROM users WHERE id = 1").fetchone() == (
+            "Changed",
+        )
+        assert db_handler.cursor.execute("SELECT COUNT(*) FROM ingested_files").fetchone() == (1,)
+        assert sorted(path.name for path in tmp_path.glob("db*")) == ["db", "db-shm", "db-wal"]
+
+        db_handler.connection.close()
+
+    def test_shadow_swap_locks_out_writers_from_the_last_check(self, tmp_path, monkeypatch):
+        """Check if no other connection can commit between the last change check and the swap"""
+
+        monkeypatch.setattr(db_auth, "HASH_ITERATIONS", 1)
+        data_directory = tmp_path / "data"
+        data_directory.mkdir()
+        shutil.copy(db_parser.manager_directory / "data" / "users.json", data_directory)
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database(data_directory=data_directory)
+        shutil.copytree(db_parser.manager_directory / "data", data_directory, dirs_exist_ok=True)
+
+        data_version = db_manager.DataHandler.data_version
+        blocked_writes = []
+
+        def check_and_write(handler):
+            version = data_version(handler)
+            if handler.connection.in_transaction:  # The check right before the swap
+                with closing(sqlite3.connect(tmp_path / "db", timeout=0)) as other_connection:
+                    with pytest.raises(sqlite3.OperationalError, match="locked"):
+                        other_connection.execute("UPDATE users SET firstname = 'Changed' WHERE id = 1")
+                blocked_writes.append(version)
+            return version
+
+        monkeypatch.setattr(db_manager.DataHandler, "data_version", check_and_write)
+        db_handler.create_database(data_directory=data_directory, shadow=True)
+
+        assert len(blocked_writes) == 1
+        assert db_handler.count_users() == 84
+        assert db_handler.cursor.execute("SELECT firstname FROM users WHERE id = 1").fetchone() != (
+            "Changed",
+        )
+
+        db_handler.connection.close()
+
+    @pytest.mark.parametrize("engine", ["sqlite", "memory"])
+    def test_server_runs_actions(self, tmp_path, engine):
+        """Check if an action requested over HTTP returns what the CLI would print"""
+
+        if engine == "sqlite":
+            db_name = str(tmp_path / "db")
+            db_manager.DataHandler(db_name).create_database()
+            pool = db_pool.ConnectionPool(db_name)
+        else:
+            pool = db_pool.MemoryPool()
+            with pool.writer() as storage:
+                storage.create_database()
+
+        handler_class = type("TestRequestHandler", (server.ScriptsRequestHandler,), {"pool": pool})
+        http_server = server.ScriptsServer(("127.0.0.1", 0), handler_class)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{http_server.server_port}/print-all-accounts",
+            data=json.dumps({"login": "opoole@example.org", "password": "+3t)mSM6xX"}).encode(),
+        )
+        with urllib.request.urlopen(request) as response:
+            assert response.read().decode() == "\n84\n\n"
+
+        http_server.shutdown()
+        http_server.server_close()
+        pool.close()
+
+
+class TestStorageEngines:
+
+    def test_writes_follow_the_ingest_rules(self, storage):
+        """Check if newer records overwrite by e-mail or phone number, and older ones are ignored"""
+
+        users = {email: user for user_id, email, *user in storage.users_with_children()}
+        oldest = storage.oldest_user()
+        count = storage.count_users()
+        first, second = [
+            user
+            for user in TEST_DATA
+            if user["email"] in users and user["email"] != oldest["email_address"]
+        ][:2]
+
+        storage.add_data(
+            [
+                # Older than the stored record: ignored
+                dict(first, firstname="Older", created_at="2000-01-01 00:00:00"),
+                # Moves to the phone number of the second user, which is removed
+                dict(
+                    first,
+                    telephone_number=second["telephone_number"],
+                    created_at="2099-01-01 00:00:00",
+                ),
+                dict(
+                    first,
+                    email="new.user@example.com",
+                    telephone_number="111222333",
+                    created_at="2099-01-01 00:00:00",
+                    children=[],
+                ),
+            ],
+            format="json",
+        )
+
+        users_after = {email: user for user_id, email, *user in storage.users_with_children()}
+        assert storage.count_users() == count == len(users_after)
+        assert second["email"] not in users_after
+        assert users_after[first["email"]][:2] == [first["firstname"], users[second["email"]][1]]
+        assert users_after["new.user@example.com"] == [first["firstname"], "111222333", []]
+        assert storage.oldest_user() == oldest
+        assert storage.authenticate_user("111222333", first["password"]).email == "new.user@example.com"
+
+    def test_engines_agree_on_generated_data(self, tmp_path, monkeypatch):
+        """Check if both engines resolve many repeated and invalid records into the same users"""
+
+        monkeypatch.setattr(db_auth, "HASH_ITERATIONS", 1)
+        generate_data.generate(
+            tmp_path / "data", 2000, files_per_format=2, duplicate_rate=0.3, invalid_rate=0.05
+        )
+
+        sqlite_storage = db_manager.DataHandler(str(tmp_path / "db"))
+        memory_storage = db_memory.MemoryStorage()
+        for engine in (sqlite_storage, memory_storage):
+            engine.create_database(batch_size=100, data_directory=tmp_path / "data")
+
+        users = list(sqlite_storage.users_with_children())
+        assert list(memory_storage.users_with_children()) == users
+        for query in ("count_users", "oldest_user", "children_age_groups"):
+            assert getattr(memory_storage, query)() == getattr(sqlite_storage, query)()
+        for user_id, email, *_ in users[::10]:
+            assert memory_storage.user_children(user_id) == sqlite_storage.user_children(user_id)
+            assert list(memory_storage.similar_children_by_age(user_id)) == list(
+                sqlite_storage.similar_children_by_age(user_id)
+            )
+            assert memory_storage.find_user("email", email)[:4] == sqlite_storage.find_user("email", email)[:4]
+
+
+class TestSnapshots:
+
+    def test_snapshot_restores_the_users_as_stored(self, storage, tmp_path):
+        """Check if a snapshot restores the same users, ids and hashes into both engines"""
+
+        # A removed user leaves a gap in the ids, which the restored store keeps
+        storage.add_data(
+            [dict(TEST_DATA[0], email="gap@example.com", telephone_number="111222333")],
+            format="json",
+        )
+        storage.add_data(
+            [dict(TEST_DATA[1], telephone_number="111222333", created_at="2099-01-01 00:00:00")],
+            format="json",
+        )
+        db_snapshot.export_snapshot(storage, tmp_path / "snapshot")
+
+        restored_stores = db_manager.DataHandler(str(tmp_path / "restored")), db_memory.MemoryStorage()
+        for restored in restored_stores:
+            db_snapshot.load_snapshot(tmp_path / "snapshot", restored)
+
+            assert list(restored.iter_stored_users()) == list(storage.iter_stored_users())
+            assert restored.next_user_id() == storage.next_user_id()
+            for query in ("count_users", "oldest_user", "children_age_groups"):
+                assert getattr(restored, query)() == getattr(storage, query)()
+            assert restored.authenticate_user("604020303", "6mKY!nP^+y").role == "admin"
+
+    def test_restored_database_skips_the_ingested_files(self, tmp_path, monkeypatch):
+        """Check if files ingested before a snapshot are skipped after an import, wherever they are"""
+
+        monkeypatch.setattr(db_auth, "HASH_ITERATIONS", 1)
+        shutil.copytree(db_parser.manager_directory / "data", tmp_path / "built")
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database(data_directory=tmp_path / "built")
+        db_snapshot.export_snapshot(db_handler, tmp_path / "snapshot")
+
+        data_directory = tmp_path / "moved"
+        shutil.copytree(tmp_path / "built", data_directory)
+        (data_directory / "users_2.csv").rename(data_directory / "renamed.csv")
+        with open(data_directory / "users_1.csv", "a") as csv_file:
+            csv_file.write("\nNew;123456789;new.user@example.com;Pass1;user;2023-12-01 10:00:00;Ala (3)\n")
+
+        restored = db_manager.DataHandler(str(tmp_path / "restored"))
+        db_snapshot.load_snapshot(tmp_path / "snapshot", restored)
+        sources = db_parser.DataParser.discover_sources(data_directory)
+
+        pending_sources = restored.find_pending_sources(sources)
+        assert [(path.name, offset > 0) for path, _, offset, _ in pending_sources] == [
+            ("users_1.csv", True)
+        ]
+
+        restored.create_database(data_directory=data_directory)
+        assert restored.count_users() == 85
+        assert restored.find_pending_sources(sources) == []
+
+    def test_version_1_snapshots_are_still_read(self, scripts_db, tmp_path):
+        """Check if a snapshot written before the data files were recorded is restored as well"""
+
+        db_snapshot.export_snapshot(scripts_db, tmp_path / "snapshot")
+
+        # Rewrite it the way version 1 laid it out: without the data file sections at the end
+        data = (tmp_path / "snapshot").read_bytes()
+        header = db_snapshot.HEADER.unpack_from(data)
+        section, table_start = db_snapshot.SECTION, db_snapshot.HEADER.size
+        sections = [
+            section.unpack_from(data, table_start + section.size * index)
+            for index in range(db_snapshot.SECTIONS_COUNT[1])
+        ]
+        shift = section.size * len(db_snapshot.FILE_SECTIONS)
+        table_end = table_start + section.size * len(db_snapshot.SECTIONS)
+        payload = b"".join(section.pack(offset - shift, size) for offset, size in sections)
+        payload += data[table_end : sum(sections[-1])]
+        (tmp_path / "snapshot").write_bytes(
+            db_snapshot.HEADER.pack(header[0], 1, zlib.crc32(payload), *header[3:]) + payload
+        )
+
+        restored = db_manager.DataHandler(str(tmp_path / "restored"))
+        db_snapshot.load_snapshot(tmp_path / "snapshot", restored)
+        assert list(restored.iter_stored_users()) == list(scripts_db.iter_stored_users())
+        assert list(restored.iter_ingested_files()) == []
+
+    def test_invalid_snapshots_are_rejected(self, scripts_db, tmp_path):
+        """Check if damaged or foreign files are not loaded, nor snapshots into a non-empty store"""
+
+        snapshot = tmp_path / "snapshot"
+        db_snapshot.export_snapshot(scripts_db, snapshot)
+
+        with pytest.raises(ValueError, match="not empty"):
+            db_snapshot.load_snapshot(snapshot, scripts_db)
+
+        data = bytearray(snapshot.read_bytes())
+        data[-1] ^= 0xFF
+        (tmp_path / "damaged").write_bytes(data)
+        with pytest.raises(ValueError, match="checksum"):
+            db_snapshot.load_snapshot(tmp_path / "damaged", db_memory.MemoryStorage())
+
+        result = script.Scripts(output_format=None).import_snapshot("users.json")
+        assert result.status == "invalid_snapshot"
+
+
+class TestAuthentication:
+
+    def test_passwords_are_stored_hashed(self, scripts_db):
+        """Check if passwords are stored as salted hashes that still accept the original password"""
+
+        scripts_db.cursor.execute("SELECT password FROM users WHERE email=?", ("opoole@example.org",))
+        password_hash = scripts_db.cursor.fetchone()[0]
+
+        assert password_hash != "+3t)mSM6xX"
+        assert db_auth.verify_password("+3t)mSM6xX", password_hash)
+        assert not db_auth.verify_password("wrong", password_hash)
+
+    def test_passwords_are_hashed_in_parallel_in_order(self):
+        """Check if the hashes of a batch hashed by several threads match their passwords in order"""
+
+        passwords = [f"password{number}" for number in range(20)]
+        password_hashes = db_auth.hash_passwords(passwords, threads=4)
+
+        assert len(set(password_hashes)) == len(passwords)
+        assert all(map(db_auth.verify_password, passwords, password_hashes))
+
+    def test_session_cache_keeps_no_plain_password_digest(self):
+        """Check if the cached password digests are keyed by the process secret, not bare SHA-256"""
+
+        _, digest = db_auth.SessionCache.key("604020303", "6mKY!nP^+y")
+
+        assert digest != hashlib.sha256(b"6mKY!nP^+y").digest()
+        assert digest == hmac.new(db_auth.SESSION_KEY, b"6mKY!nP^+y", "sha256").digest()
+
+    def test_session_is_cached_until_the_user_changes(self, storage, monkeypatch):
+        """Check if a verified login is served from the cache, and forgotten once the user is updated"""
+
+        login, password = "604020303", "6mKY!nP^+y"
+
+        session = storage.authenticate_user(login, password)
+        assert session.role == "admin"
+        assert storage.authenticate_user(login, "wrong") is None
+
+        with monkeypatch.context() as patched:
+            patched.setattr(storage, "find_user", None)  # A cached login must not touch the store
+            assert storage.authenticate_user(login, password) == session
+
+        user = dict(TEST_DATA[0], telephone_number=login, email=session.email, password="new")
+        storage.add_data([dict(user, created_at="2030-01-01 00:00:00")], format="json")
+
+        assert storage.sessions.get(login, password) is None
+        assert storage.authenticate_user(login, password) is None
+        assert storage.authenticate_user(login, "new").role == user["role"]
+
+
+class TestAsyncScripts:
+
+    def test_actions_return_structured_results(self, tmp_path):
+        """Check if the coroutine actions return the data the CLI prints, and raise on a wrong login"""
+
+        db_name = str(tmp_path / "db")
+        db_manager.DataHandler(db_name).create_database()
+
+        async def run_actions():
+            async with async_scripts.AsyncScripts(db_name, workers=2) as scripts:
+                results = await asyncio.gather(
+                    scripts.print_all_accounts("opoole@example.org", "+3t)mSM6xX"),
+                    scripts.print_children("604020303", "6mKY!nP^+y"),
+                )
+
+                with pytest.raises(db_auth.AdminRoleRequired):
+                    await scripts.group_by_age("jason92@example.org", "Z#7VMvf%d^")
+                with pytest.raises(db_auth.InvalidLogin):
+                    await scripts.print_children("jason92@example.org", "wrong")
+
+                return results
+
+        accounts, children = asyncio.run(run_actions())
+
+        assert accounts == 84
+        assert children == [{"name": "Anna", "age": 18}, {"name": "Mindy", "age": 11}]
+
+
+class TestStartup:
+
+    # Loaded by create_database (and snapshots) only; a query action must not pay for them
+    INGEST_MODULES = (
+        "database.db_parser",
+        "database.db_snapshot",
+        "xml.etree.ElementTree",
+        "csv",
+        "concurrent.futures",
+        "multiprocessing",
+    )
+    IMPORT_TIME_BUDGET = 0.1  # Seconds to import script.py; generous, for slow machines
+
+    @staticmethod
+    def import_times(*args, cwd=None):
+        """Output of a Python process run with -X importtime, and the modules it imported"""
+
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Lines look like 'import time: <self us> | <cumulative us> | <indented module name>'
+        modules = {}
+        for line in process.stderr.splitlines():
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():  # Not the header line
+                modules[name.strip()] = int(cumulative) / 1_000_000
+
+        return process.stdout, modules
+
+    def test_query_actions_skip_ingest_modules(self, tmp_path):
+        """Check if a query action run from the command line imports nothing the ingest needs"""
+
+        db_manager.DataHandler(str(tmp_path / "dbsqlite3")).create_database()
+
+        stdout, modules = self.import_times(
+            str(Path(script.__file__).resolve()),
+            "print-all-accounts",
+            "--login",
+            "opoole@example.org",
+            "--password",
+            "+3t)mSM6xX",
+            cwd=tmp_path,
+        )
+
+        assert stdout == "\n84\n\n"
+        assert not set(self.INGEST_MODULES).intersection(modules)
+
+    def test_script_import_time_is_within_budget(self):
+        """Check if importing script.py stays within the import-time budget"""
+
+        _, modules = self.import_times("-c", "import script", cwd=Path(script.__file__).parent)
+
+        assert not set(self.INGEST_MODULES).intersection(modules)
+        assert modules["script"] < self.IMPORT_TIME_BUDGET
+
+
+class TestBenchmarkData:
+
+    def test_generated_files_are_deterministic_and_ingestible(self, tmp_path):
+        """Check if the generator writes the same files for a seed, in formats create_database reads"""
+
+        first = generate_data.generate(tmp_path / "first", 300, duplicate_rate=0.2, seed=7)
+        second = generate_data.generate(tmp_path / "second", 300, duplicate_rate=0.2, seed=7)
+        assert [path.read_bytes() for path in first] == [path.read_bytes() for path in second]
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        db_handler.create_database(data_directory=tmp_path / "first")
+
+        expected_users = list(generate_data.generate_users(300, duplicate_rate=0.2, seed=7))
+        assert 0 < db_handler.count_users() < len(expected_users)  # Repeated and invalid users are dropped
+        assert db_handler.authenticate_user(
+            generate_data.BENCHMARK_LOGIN, generate_data.BENCHMARK_PASSWORD
+        ).role == "admin"
+
+
+class TestMetrics:
+
+    @pytest.fixture
+    def metrics(self):
+        db_metrics.reset()
+        db_metrics.enable()
+        yield db_metrics.registry
+        db_metrics.disable()
+        db_metrics.reset()
+
+    def test_ingest_and_actions_are_measured(self, metrics, tmp_path):
+        """Check if the ingest stages, counters and action latencies are recorded and exported"""
+
+        db_handler = db_manager.DataHandler(str(tmp_path / "db"))
+        scripts = script.Scripts(db_handler, out=io.StringIO())
+        scripts.create_database()
+        scripts.group_by_age("opoole@example.org", "+3t)mSM6xX")
+
+        recorded = metrics.as_dict()
+        assert {
+            "parse_json", "parse_csv", "parse_xml", "normalize", "validate",
+            "dedup_lookup", "dedup_resolve", "hash_passwords", "write", "commit",
+        } <= set(recorded["stages"])
+        assert recorded["counters"]["rows_inserted"] == db_handler.count_users() == 84
+        assert recorded["actions"]["group_by_age"]["count"] == 1
+        assert recorded["actions"]["create_database"]["buckets"]["+Inf"] == 1
+
+        db_metrics.export(tmp_path / "metrics.json")
+        assert json.loads((tmp_path / "metrics.json").read_text()) == json.loads(json.dumps(recorded))
+
+        db_metrics.export(tmp_path / "metrics.prom")
+        assert 'users_db_action_seconds_count{action="group_by_age"} 1' in (
+            (tmp_path / "metrics.prom").read_text().splitlines()
+        )
+
+    def test_disabled_metrics_record_nothing(self, tmp_path):
+        """Check if nothing is collected unless the metrics are enabled"""
+
+        db_metrics.reset()
+        data = [1, 2]
+        assert db_metrics.timed_iter("parse_json", data) is data
+        assert db_metrics.timer("write") is db_metrics.timer("commit")
+
+        db_manager.DataHandler(str(tmp_path / "db")).create_database()
+
+        assert db_metrics.registry.as_dict() == {"stages": {}, "counters": {}, "actions": {}}